@@ -0,0 +1,21 @@
+import sys
+from utils.config import Config
+from utils.benchmark import RideBenchmark, save_baseline, compare_to_baseline
+
+if __name__ == '__main__':
+    # Usage: python BENCHMARK_launch.py [--save-baseline]
+    # Benchmarks every ETL stage on synthetic rides of the Config's benchmark_params and compares the throughput and
+    # peak memory to the stored baseline (--save-baseline stores this run as the new baseline instead)
+    config = Config()
+    benchmark = RideBenchmark(calc_params=config.power_estimation_params, **config.benchmark_params)
+    df_results = benchmark.run()
+
+    if '--save-baseline' in sys.argv[1:]:
+        save_baseline(df_results, config.benchmark_path)
+        print(f'Saved the benchmark baseline to {config.benchmark_path}')
+    else:
+        df_compare = compare_to_baseline(df_results, config.benchmark_path, tolerance=0.2)
+        print(df_compare.to_string(index=False, float_format='{:.3g}'.format))
+        if df_compare['is_regression'].any():
+            print('Regressions: ' + ', '.join(f'{r.stage} ({r.ride_length} points)' for r in df_compare.loc[df_compare['is_regression']].itertuples()))
+            sys.exit(1)
@@ -0,0 +1,23 @@
+import sys
+from os import cpu_count
+from utils.config import Config
+from utils.storage import list_ride_files
+from utils.metadata import get_ride_metadata
+from utils.calibration import PowerCalibrator, save_calibrated_params
+
+if __name__ == '__main__':
+    # Usage: python CALIBRATE_launch.py [n_refinements]
+    # Fits the Config's calibration_grid params against the rides with a measured avg_power and saves them as the 
+    # next version in the Config's calibration_path. Set the Config's power_params_version to use them.
+    config = Config()
+    n_refinements = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    calibrator = PowerCalibrator(ride_files=list_ride_files(config.cleaned_ride_path), 
+                                 calc_params=config.power_estimation_params,
+                                 ride_metadata=get_ride_metadata(config.activity_log_path), 
+                                 n_workers=cpu_count())
+    fitted_params = calibrator.fit(config.calibration_grid, loss='median', n_refinements=n_refinements)
+    best = calibrator.df_results.iloc[0]
+    version = save_calibrated_params(fitted_params, config.calibration_path, 
+                                     fit_details={'loss': 'median', 'error': best['loss'], 'ride_count': len(calibrator.ride_ids),
+                                                  'grid': config.calibration_grid})
+    print(f'Saved version {version} of the calibrated power params')
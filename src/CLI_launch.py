@@ -0,0 +1,108 @@
+import os
+import sys
+import argparse
+
+# Only the standard library is imported up front: the ETL modules (pandas, numpy, scipy, ...) are imported by the
+# command that needs them, so --help and the stage listing start instantly
+
+def main(argv=None):
+    """
+    Usage: python CLI_launch.py [--root-dir DIR] <command> [options]
+        stages                                             list the ride stages
+        run [--stages normalize,enrich] [--rides 123,456]  run the selected ride stages (default: every stage)
+        agg                                                aggregate the ride files into the enriched Activity Log
+    The project directory comes from --root-dir, or else the STRAVA_FITNESS_ROOT environment variable, or else the Config.
+    """
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if args.root_dir is not None:
+        # Set before the Config is built, so the worker processes see it too
+        os.environ['STRAVA_FITNESS_ROOT'] = args.root_dir
+    return args.command_func(args)
+
+################################################################
+# COMMANDS
+################################################################
+
+def list_stages(args):
+    from utils.stages import RIDE_STAGES
+    for stage_name, (_, description) in RIDE_STAGES.items():
+        print(f'{stage_name:<10} {description}')
+    return 0
+
+def run_stages(args):
+    from utils.stages import FUSED_STAGES, parse_stage_names
+    try:
+        stage_names = parse_stage_names(FUSED_STAGES if (args.fused and args.stages is None) else args.stages)
+    except ValueError as error:
+        raise SystemExit(str(error))
+    if args.fused and (set(stage_names) - {'extract'} != set(FUSED_STAGES)):
+        raise SystemExit(f'--fused always runs the {FUSED_STAGES} stages (and "extract" when it is in --stages)')
+
+    from utils.etl import RideETL
+    ride_etl_pipeline = RideETL(n_workers=args.workers, incremental=False if args.full else None,
+                                instrumentation=_get_instrumentation(args), io_threads=args.io_threads,
+                                ride_ids=_parse_ride_ids(args.rides))
+    if args.fused:
+        ride_etl_pipeline.run_fused_pipeline(include_extract='extract' in stage_names)
+    else:
+        ride_etl_pipeline.run_stages(stage_names)
+    return 1 if len(ride_etl_pipeline.failed_rides) > 0 else 0
+
+def run_aggregations(args):
+    from utils.etl import LogETL
+    log_aggregation_pipeline = LogETL(incremental=False if args.full else None, instrumentation=_get_instrumentation(args),
+                                      io_threads=args.io_threads)
+    log_aggregation_pipeline.run_pipeline()
+    return 0
+
+################################################################
+# HELPERS
+################################################################
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog='strava-etl', description='Runs the Strava ride ETL stages and aggregations')
+    parser.add_argument('--root-dir', default=None, help='project directory (default: $STRAVA_FITNESS_ROOT or the Config)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stages_parser = commands.add_parser('stages', help='list the ride stages')
+    stages_parser.set_defaults(command_func=list_stages)
+
+    run_parser = commands.add_parser('run', help='run ride stages')
+    run_parser.add_argument('--stages', default=None, help='comma separated stages to run, in pipeline order (default: every stage)')
+    run_parser.add_argument('--rides', default=None, help='comma separated ride_ids, or @file with one ride_id per line (default: every ride)')
+    run_parser.add_argument('--fused', action='store_true', help='run the transform stages back to back on each ride (from the GPX files with --stages extract,normalize,...)')
+    run_parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: the Config)')
+    _add_common_arguments(run_parser)
+    run_parser.set_defaults(command_func=run_stages)
+
+    agg_parser = commands.add_parser('agg', help='aggregate the ride files into the enriched Activity Log')
+    _add_common_arguments(agg_parser)
+    agg_parser.set_defaults(command_func=run_aggregations)
+    return parser
+
+def _add_common_arguments(parser):
+    parser.add_argument('--full', action='store_true', help='process every ride instead of only the new or changed ones')
+    parser.add_argument('--io-threads', type=int, default=None, help='threads overlapping the file I/O (default: the Config)')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], default=None, help='profile every ride of each stage')
+
+def _get_instrumentation(args):
+    # None = the Config's default instrumentation
+    if args.profile is None:
+        return None
+    from utils.config import Config
+    from utils.instrument import get_instrumentation
+    config = Config()
+    return get_instrumentation(config.metrics_path, profiler=args.profile, profile_path=config.profile_path)
+
+def _parse_ride_ids(rides):
+    if rides is None:
+        return None
+    if rides.startswith('@'):
+        with open(rides[1:], 'r') as opened_file:
+            return [int(line) for line in opened_file.read().split() if line.strip() != '']
+    return [int(ride_id) for ride_id in rides.split(',') if ride_id.strip() != '']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+from utils.config import Config
+from utils.dataset import RideDataset
+from utils.storage import list_ride_files
+
+if __name__ == '__main__':
+    # Usage: python DATASET_launch.py
+    # Rebuilds the combined, partitioned dataset of every cleaned ride. Run it after the ETL pipeline.
+    config = Config()
+    ride_files = list_ride_files(config.cleaned_ride_path)
+    dataset = RideDataset(dataset_path=config.ride_dataset_path, partition_by=config.ride_dataset_partition)
+    dataset.build(ride_files)
@@ -0,0 +1,10 @@
+from utils.config import Config
+from utils.storage import get_memory_report, list_ride_files
+
+if __name__ == '__main__':
+    # Usage: python MEMORY_launch.py
+    # Reports how much memory each cleaned ride takes with pandas' default dtypes vs. the ride schema (utils/schema.py)
+    config = Config()
+    ride_files = list_ride_files(config.cleaned_ride_path)
+    df_sizes = get_memory_report(ride_files)
+    print(df_sizes.to_string(index=False))
@@ -0,0 +1,13 @@
+import sys
+from utils.config import Config
+from utils.storage import migrate_ride_files
+
+if __name__ == '__main__':
+    # Usage: python MIGRATE_launch.py [parquet|feather] [--remove-csv]
+    # Converts the cleaned CSV ride files into the columnar format in place.
+    # Set the Config's ride_file_format to the same format afterwards so the ETL reads and writes it.
+    config = Config()
+    file_format = sys.argv[1] if len(sys.argv) > 1 else 'parquet'
+    remove_source = '--remove-csv' in sys.argv
+    migrate_ride_files(input_path=config.cleaned_ride_path, output_path=config.cleaned_ride_path, 
+                       file_format=file_format, remove_source=remove_source)
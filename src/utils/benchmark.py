@@ -0,0 +1,279 @@
+import gc
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from os import makedirs
+from os.path import join, isfile, dirname
+
+from utils.extract import read_gpx_to_dataframe
+from utils.storage import get_ride_store
+from utils.metadata import RideMetadata
+from utils.training import TrainingCalendar
+from utils.pandaswindow import PandasWindow
+from utils.transform.normalize import TimeNormalizer
+from utils.transform.enrich import BasicEnricher, PowerEstimator
+from utils.transform.clean import PrivacyZoner, SignalFilter
+
+# Columbus, OH
+SYNTHETIC_CENTER = (40.0, -83.0)
+
+################################################################
+# SYNTHETIC RIDE GENERATOR
+################################################################
+
+def generate_synthetic_ride(ride_id, n_points, sample_period=1, dropout=0.0, n_segments=1,
+                            start_time='2020-06-01 12:00:00', seed=0) -> pd.DataFrame:
+    """
+    Generates a ride in the extracted format (ride_id | segment_id | time | elevation | latitude | longitude),
+    the same as read_gpx_to_dataframe() returns, so that every stage can be benchmarked without the private rides.
+
+    @n_points = number of GPS points recorded (before the dropout)
+    @sample_period = seconds between the recorded points
+    @dropout = fraction of the points randomly dropped (e.g. lost GPS signal)
+    @n_segments = number of continuous segments, separated by pauses longer than the time gap threshold
+    @seed = seed of the random generator, the same seed always generates the same ride
+    """
+    rng = np.random.default_rng(seed)
+
+    # Time: a point every @sample_period seconds with a 1 to 10 minute pause between the segments
+    steps = np.full(n_points, float(sample_period))
+    steps[0] = 0.0
+    pause_points = np.sort(rng.choice(np.arange(1, n_points), size=min(n_segments-1, n_points-1), replace=False))
+    steps[pause_points] += rng.uniform(60, 600, size=len(pause_points))
+    elapsed = np.round(np.cumsum(steps))
+    times = pd.Timestamp(start_time, tz='UTC') + pd.to_timedelta(elapsed, unit='s')
+
+    # Route: a smooth random walk at 5 to 20 MPH (speeds in miles/sec, 1 degree of latitude ~ 69 miles)
+    speed = np.clip(12 + np.cumsum(rng.normal(0, 0.3, n_points)), 5, 20) / 3600
+    heading = np.cumsum(rng.normal(0, 0.05, n_points)) + rng.uniform(0, 2*np.pi)
+    step_miles = speed * sample_period
+    latitude = SYNTHETIC_CENTER[0] + np.cumsum(step_miles * np.sin(heading)) / 69.0
+    longitude = SYNTHETIC_CENTER[1] + np.cumsum(step_miles * np.cos(heading)) / (69.0 * np.cos(np.radians(SYNTHETIC_CENTER[0])))
+    elevation = 250 + np.cumsum(rng.normal(0, 0.1, n_points))
+
+    df = pd.DataFrame({'ride_id': np.int64(ride_id), 'segment_id': np.int64(-1), 'time': times, 'elevation': elevation,
+                       'latitude': latitude, 'longitude': longitude})
+
+    # Drop random points (never the first one)
+    filt_keep = rng.random(n_points) >= dropout
+    filt_keep[0] = True
+    return df.loc[filt_keep].reset_index(drop=True)
+
+def generate_privacy_zones(df_ride, n_zones, radius=0.2, seed=0) -> pd.DataFrame:
+    """
+    Generates @n_zones privacy zones (name | latitude | longitude | privacy_radius), a few of them on the route
+    of @df_ride and the rest scattered within ~50 miles
+    """
+    rng = np.random.default_rng(seed)
+    n_on_route = min(max(n_zones // 10, 1), n_zones)
+    route_points = rng.choice(df_ride.shape[0], size=n_on_route)
+    latitude = np.concatenate([df_ride['latitude'].values[route_points], SYNTHETIC_CENTER[0] + rng.uniform(-0.7, 0.7, n_zones-n_on_route)])
+    longitude = np.concatenate([df_ride['longitude'].values[route_points], SYNTHETIC_CENTER[1] + rng.uniform(-0.9, 0.9, n_zones-n_on_route)])
+    return pd.DataFrame({'name': [f'zone_{i}' for i in range(n_zones)], 'latitude': latitude, 'longitude': longitude,
+                         'privacy_radius': radius})
+
+def write_synthetic_gpx(df, file_path):
+    """
+    Writes a generated ride as a GPX file (the format of the raw ride files)
+    """
+    points = [f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{time:%Y-%m-%dT%H:%M:%SZ}</time></trkpt>'
+              for lat, lon, ele, time in zip(df['latitude'], df['longitude'], df['elevation'], df['time'])]
+    with open(file_path, 'w') as opened_file:
+        opened_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        opened_file.write('<trk><trkseg>\n' + '\n'.join(points) + '\n</trkseg></trk>\n</gpx>\n')
+
+
+class RideBenchmark():
+    """
+    Benchmarks each ETL stage in isolation on synthetic rides and reports, for each stage and ride length:
+        stage | ride_length | n_points | seconds | points_per_sec | peak_mb
+    where ride_length is the number of recorded points of the synthetic ride and n_points the number of points
+    the stage processed (e.g. after the dropout, or the 1 Hz points after the normalization).
+
+    The input of a stage is prepared by running the stages before it (untimed). The timing is the best of
+    @repeats runs without memory tracing, then one more run under tracemalloc measures the peak memory.
+    Running over several ride lengths gives the scaling curve of each stage.
+    """
+    stages = ['extract', 'normalize', 'enrich', 'privacy', 'filter', 'power', 'pandas_window', 'aggregate']
+
+    def __init__(self, ride_lengths=None, sample_period=1, dropout=0.1, n_segments=4, n_privacy_zones=50,
+                 n_aggregate_rides=10, repeats=3, calc_params=None, seed=0):
+        """
+        Inputs:
+        @ride_lengths = list of the number of recorded points of the benchmarked rides
+        @sample_period, @dropout, @n_segments = the shape of the synthetic rides (see generate_synthetic_ride)
+        @n_privacy_zones = number of privacy zones checked by the privacy stage
+        @n_aggregate_rides = number of ride files the aggregate stage runs over
+        @repeats = number of timed runs of each stage (the best one is kept)
+        @calc_params = the power_estimation_params of the power stage
+        """
+        self.ride_lengths = [1000, 4000, 16000] if ride_lengths is None else ride_lengths
+        self.sample_period = sample_period
+        self.dropout = dropout
+        self.n_segments = n_segments
+        self.n_privacy_zones = n_privacy_zones
+        self.n_aggregate_rides = n_aggregate_rides
+        self.repeats = repeats
+        self.calc_params = calc_params
+        self.seed = seed
+        self.df_results = None
+
+    def run(self, stages=None):
+        stages = self.stages if stages is None else stages
+        results = []
+        work_path = tempfile.mkdtemp(prefix='ride_benchmark_')
+        try:
+            for n_points in self.ride_lengths:
+                stage_inputs = self._prepare_stage_inputs(n_points, work_path)
+                for stage in stages:
+                    func, n_stage_points = stage_inputs[stage]
+                    seconds, peak_bytes = self._measure(func)
+                    results.append({'stage': stage, 'ride_length': n_points, 'n_points': n_stage_points, 'seconds': seconds,
+                                    'points_per_sec': n_stage_points / seconds if seconds > 0 else np.nan,
+                                    'peak_mb': peak_bytes / 1e6})
+                    print(f'{stage:>14} {n_stage_points:>9} points {seconds*1e3:>10.2f} ms {results[-1]["points_per_sec"]:>14,.0f} points/sec {peak_bytes/1e6:>8.1f} MB')
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+        self.df_results = pd.DataFrame(data=results)
+        return self.df_results
+
+    ################################################################
+    # PROCESS METHODS
+    ################################################################
+
+    def _prepare_stage_inputs(self, n_points, work_path):
+        # Returns {stage: (function running the stage on a copy of its input, number of points processed)}
+        df_extracted = generate_synthetic_ride(1000, n_points, sample_period=self.sample_period, dropout=self.dropout,
+                                               n_segments=self.n_segments, seed=self.seed)
+        gpx_path = join(work_path, '1000.gpx')
+        write_synthetic_gpx(df_extracted, gpx_path)
+
+        # Run the stages once to get the input of each stage
+        normalizer = TimeNormalizer(df_extracted.copy(), time_gap_threshold=15)
+        normalizer.run()
+        df_normalized = normalizer.df_upsampled
+        calendar = TrainingCalendar()
+        enricher = BasicEnricher(df_normalized.copy(), training_calendar=calendar)
+        enricher.run()
+        df_enriched = enricher.df
+        df_privacy = generate_privacy_zones(df_enriched, self.n_privacy_zones, seed=self.seed)
+        protector = PrivacyZoner(df_enriched.copy(), df_privacy=df_privacy)
+        protector.run()
+        filterer = SignalFilter(protector.df.copy())
+        filterer.run()
+        df_filtered = filterer.df
+
+        # The power stage looks the bike weight up in the Activity Log
+        log_path = join(work_path, 'activity_log.csv')
+        ride_ids = [1000 + i for i in range(max(self.n_aggregate_rides, 1))]
+        pd.DataFrame({'ride_id': ride_ids, 'bike_weight': 10.0, 'avg_power': np.nan}).to_csv(log_path, index=False)
+        ride_metadata = RideMetadata(log_path)
+        calc_params = self.calc_params if self.calc_params is not None else _default_calc_params()
+        estimator = PowerEstimator(df_filtered.copy(), calc_params, ride_metadata=ride_metadata)
+        estimator.run()
+
+        # The aggregate stage reads @n_aggregate_rides cleaned ride files
+        ride_path = join(work_path, 'cleaned')
+        shutil.rmtree(ride_path, ignore_errors=True)
+        makedirs(ride_path)
+        store = get_ride_store('csv')
+        ride_files = [store.write(estimator.df.assign(ride_id=ride_id), ride_path, ride_id) for ride_id in ride_ids]
+
+        def run_stage(stage_class, df, **kwargs):
+            def func():
+                stage = stage_class(df.copy(), **kwargs)
+                stage.run()
+            return func
+
+        def run_pandas_window():
+            window = PandasWindow(partition_by='segment_id', order_by='time')
+            window.apply_func(df_normalized.copy(), func=lambda df: df.assign(delta_elevation=df['elevation'].diff()))
+
+        def run_aggregate():
+            _run_log_aggregations(ride_files, log_path)
+
+        return {'extract': (lambda: read_gpx_to_dataframe(gpx_path), df_extracted.shape[0]),
+                'normalize': (run_stage(TimeNormalizer, df_extracted, time_gap_threshold=15), df_extracted.shape[0]),
+                'enrich': (run_stage(BasicEnricher, df_normalized, training_calendar=calendar), df_normalized.shape[0]),
+                'privacy': (run_stage(PrivacyZoner, df_enriched, df_privacy=df_privacy), df_enriched.shape[0]),
+                'filter': (run_stage(SignalFilter, protector.df), df_enriched.shape[0]),
+                'power': (run_stage(PowerEstimator, df_filtered, calc_params=calc_params, ride_metadata=ride_metadata),
+                          df_filtered.shape[0]),
+                'pandas_window': (run_pandas_window, df_normalized.shape[0]),
+                'aggregate': (run_aggregate, estimator.df.shape[0] * len(ride_files))}
+
+    def _measure(self, func):
+        # Best time of the repeats (without tracing) and the peak traced memory of one more run
+        timings = []
+        for _ in range(self.repeats):
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+
+        gc.collect()
+        tracemalloc.start()
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return min(timings), peak_bytes
+
+
+################################################################
+# BASELINES
+################################################################
+
+def save_baseline(df_results, baseline_path):
+    """
+    Stores the @df_results of a benchmark run as the baseline that later runs are compared to
+    """
+    if dirname(baseline_path):
+        makedirs(dirname(baseline_path), exist_ok=True)
+    with open(baseline_path, 'w') as opened_file:
+        json.dump({'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+                   'results': df_results.to_dict(orient='records')}, opened_file, indent=4)
+
+def compare_to_baseline(df_results, baseline_path, tolerance=0.2):
+    """
+    Compares the throughput and peak memory of each stage and ride length to the stored baseline.
+    A stage is flagged as a regression when it is more than @tolerance (e.g. 20%) slower or uses more than
+    @tolerance more memory than the baseline.
+
+    Returns a dataframe of: stage | ride_length | points_per_sec | baseline_points_per_sec | speedup | peak_mb |
+                            baseline_peak_mb | memory_ratio | is_regression
+    """
+    if not isfile(baseline_path):
+        raise FileNotFoundError(f'There is no benchmark baseline at {baseline_path}')
+    with open(baseline_path, 'r') as opened_file:
+        df_baseline = pd.DataFrame(data=json.load(opened_file)['results'])
+
+    df_baseline = df_baseline[['stage', 'ride_length', 'points_per_sec', 'peak_mb']]
+    df_compare = df_results.merge(df_baseline, on=['stage', 'ride_length'], how='left', suffixes=('', '_baseline'))
+    df_compare = df_compare.rename(columns={'points_per_sec_baseline': 'baseline_points_per_sec',
+                                            'peak_mb_baseline': 'baseline_peak_mb'})
+    df_compare['speedup'] = df_compare['points_per_sec'] / df_compare['baseline_points_per_sec']
+    df_compare['memory_ratio'] = df_compare['peak_mb'] / df_compare['baseline_peak_mb']
+    df_compare['is_regression'] = (df_compare['speedup'] < 1 - tolerance) | (df_compare['memory_ratio'] > 1 + tolerance)
+    return df_compare[['stage', 'ride_length', 'points_per_sec', 'baseline_points_per_sec', 'speedup',
+                       'peak_mb', 'baseline_peak_mb', 'memory_ratio', 'is_regression']]
+
+################################################################
+# HELPERS
+################################################################
+
+def _run_log_aggregations(ride_files, log_path):
+    # Runs the LogETL aggregations over the @ride_files (imported here, utils.etl imports every stage)
+    from utils.etl import LogETL
+    from utils.instrument import Instrumentation
+    log_etl = LogETL(incremental=False, instrumentation=Instrumentation())
+    log_etl.ride_files = ride_files
+    log_etl.df_log = pd.read_csv(log_path)[['ride_id']]
+    log_etl.run_aggregations()
+
+def _default_calc_params():
+    from utils.config import Config
+    return Config().power_estimation_params
@@ -0,0 +1,255 @@
+import json
+import itertools
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from datetime import datetime
+from os import listdir, makedirs
+from os.path import join, isdir
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.extract import get_ride_id
+from utils.storage import read_ride_file
+from utils.transform.enrich import estimate_power
+
+class PowerCalibrator():
+    """
+    Fits the power_estimation_params (e.g. CdA, Crr and the drive train efficiency) against the rides of the
+    Activity Log that have an average power measured by a power meter.
+
+    The filtered speed and grade of the rides are loaded once. Every candidate parameter set is then evaluated on
+    every ride with batched array operations: the rides are concatenated into chunks of points, and each chunk is
+    run through estimate_power() for a block of parameter sets at once, giving an array of (parameter sets, points).
+    The chunks can be spread over worker processes.
+    """
+    def __init__(self, ride_files, calc_params, ride_metadata, weather_table=None, measured_column='avg_power',
+                 n_workers=1, chunk_points=200000, block_size=64):
+        """
+        Inputs:
+        @ride_files = the cleaned ride files to calibrate against (rides without a measured power are skipped)
+        @calc_params = the Config's power_estimation_params, the params that aren't fitted keep these values
+        @ride_metadata = RideMetadata lookup of the Activity Log (bike_weight and the @measured_column)
+        @weather_table = a WeatherTable to include the wind (None = no wind)
+        @measured_column = the Activity Log column of the measured average power
+        @n_workers = number of worker processes evaluating the chunks (1 = run in the main process)
+        @chunk_points = number of ride points evaluated together in a chunk
+        @block_size = number of parameter sets evaluated together on a chunk
+        """
+        self.ride_files = ride_files
+        self.calc_params = calc_params
+        self.ride_metadata = ride_metadata
+        self.weather_table = weather_table
+        self.measured_column = measured_column
+        self.n_workers = n_workers
+        self.chunk_points = chunk_points
+        self.block_size = block_size
+        self.ride_ids = None
+        self.measured_power = None
+        self.chunks = None
+        self.df_results = None # loss of every evaluated parameter set
+
+    def fit(self, param_grid, loss='median', n_refinements=0):
+        """
+        Grid search of the @param_grid = {param name: list of candidate values}, e.g. {'cda': [...], 'mu_rr': [...]}
+        Every combination of the candidate values is evaluated on every ride.
+
+        @loss = how the errors between the estimated and the measured average powers are combined:
+                'median' (median absolute error, robust to rides with broken power estimates), 'mae' or 'rmse'
+        @n_refinements = number of times the search is repeated on a finer grid around the best parameter set
+
+        Returns a dictionary of the calc_params updated with the best fitted values
+        """
+        if self.chunks is None:
+            self._load_rides()
+
+        results = []
+        for refinement in range(n_refinements + 1):
+            param_sets = self._build_param_sets(param_grid)
+            estimated_power = self.evaluate(param_sets)
+            df_results = pd.DataFrame(data=param_sets)
+            df_results['loss'] = self._get_loss(estimated_power, loss)
+            df_results['refinement'] = refinement
+            results.append(df_results)
+            best_params = df_results.loc[df_results['loss'].idxmin(), list(param_grid.keys())].to_dict()
+            param_grid = self._refine_grid(param_grid, best_params)
+
+        self.df_results = pd.concat(results, ignore_index=True).sort_values('loss').reset_index(drop=True)
+        best = self.df_results.iloc[0]
+        fitted_params = dict(self.calc_params)
+        fitted_params.update({name: float(best[name]) for name in param_grid.keys()})
+        print(f'Best {loss} error of {best["loss"]:.2f} W on {len(self.ride_ids)} rides with ' +
+              ', '.join([f'{name}={best[name]:.5g}' for name in param_grid.keys()]))
+        return fitted_params
+
+    def evaluate(self, param_sets):
+        """
+        Returns the (parameter sets, rides) array of the estimated average power of each ride
+        for each of the @param_sets = {param name: array of k values}
+        """
+        if self.chunks is None:
+            self._load_rides()
+        params = dict(self.calc_params)
+        params.update({name: np.asarray(values, dtype=float) for name, values in param_sets.items()})
+        k = len(next(iter(param_sets.values()))) if len(param_sets) > 0 else 1
+
+        # Split the parameter sets into blocks so a chunk's (parameter sets, points) arrays stay bounded
+        blocks = [(start, min(start + self.block_size, k)) for start in range(0, k, self.block_size)]
+        tasks = [(chunk, _select_block(params, param_sets, start, stop)) for chunk in self.chunks for start, stop in blocks]
+
+        if self.n_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                chunk_results = list(tqdm(executor.map(evaluate_chunk, *zip(*tasks)), total=len(tasks)))
+        else:
+            chunk_results = [evaluate_chunk(chunk, block_params) for chunk, block_params in tqdm(tasks)]
+
+        # Reassemble the blocks of parameter sets (rows) and the chunks of rides (columns)
+        n_blocks = len(blocks)
+        chunk_columns = [np.vstack(chunk_results[i:i+n_blocks]) for i in range(0, len(chunk_results), n_blocks)]
+        return np.hstack(chunk_columns)
+
+    ################################################################
+    # PROCESS METHODS
+    ################################################################
+
+    def _load_rides(self):
+        # Load the points of the rides with a measured power and group them into chunks of about chunk_points points
+        print(f'Loading the rides with a measured "{self.measured_column}" out of {len(self.ride_files)} ride files')
+        columns = ['ride_id', 'filt_speed', 'filt_grade'] + (['time', 'heading'] if self.weather_table is not None else [])
+        self.ride_ids, self.measured_power, self.chunks = [], [], []
+        chunk_rides = []
+        for ride_file in tqdm(self.ride_files):
+            ride_id = int(get_ride_id(ride_file))
+            measured_power = self.ride_metadata.get(ride_id, self.measured_column)
+            if (measured_power is None) or np.isnan(measured_power) or (measured_power <= 0):
+                continue
+            df = read_ride_file(ride_file, columns=columns)
+            if (df.shape[0] == 0) or df['filt_speed'].isna().all():
+                # A ride without points has no estimated power (and an empty ride would break the per ride sums)
+                continue
+            wind = 0.0
+            if self.weather_table is not None:
+                wind = self.weather_table.get_headwind(ride_id, df['time'], df['heading'].values)
+            chunk_rides.append({'filt_speed': df['filt_speed'].to_numpy(dtype=float),
+                                'filt_grade': df['filt_grade'].to_numpy(dtype=float),
+                                'wind': np.broadcast_to(np.asarray(wind, dtype=float), (df.shape[0],)),
+                                'bike_weight': self.ride_metadata.get(ride_id, 'bike_weight')})
+            self.ride_ids.append(ride_id)
+            self.measured_power.append(measured_power)
+            if sum(len(ride['filt_speed']) for ride in chunk_rides) >= self.chunk_points:
+                self.chunks.append(_build_chunk(chunk_rides))
+                chunk_rides = []
+        if len(chunk_rides) > 0:
+            self.chunks.append(_build_chunk(chunk_rides))
+        self.measured_power = np.array(self.measured_power, dtype=float)
+
+        if len(self.ride_ids) == 0:
+            raise ValueError(f'None of the rides have a measured "{self.measured_column}" to calibrate against')
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    @staticmethod
+    def _build_param_sets(param_grid):
+        # Every combination of the candidate values: {param name: array of k values}
+        names = list(param_grid.keys())
+        combinations = list(itertools.product(*[param_grid[name] for name in names]))
+        return {name: np.array([combination[i] for combination in combinations], dtype=float) for i, name in enumerate(names)}
+
+    @staticmethod
+    def _refine_grid(param_grid, best_params):
+        # A grid with as many candidates as before spanning the 2 neighbouring candidates of the best value
+        refined_grid = {}
+        for name, candidates in param_grid.items():
+            candidates = np.sort(np.asarray(candidates, dtype=float))
+            if len(candidates) < 2:
+                refined_grid[name] = candidates
+                continue
+            i = int(np.argmin(np.abs(candidates - best_params[name])))
+            low, high = candidates[max(i-1, 0)], candidates[min(i+1, len(candidates)-1)]
+            refined_grid[name] = np.linspace(low, high, len(candidates))
+        return refined_grid
+
+    def _get_loss(self, estimated_power, loss):
+        # Combine the errors of the rides into a single loss per parameter set (rides without an estimate are ignored)
+        errors = estimated_power - self.measured_power.reshape(1, -1)
+        if loss == 'median':
+            return np.nanmedian(np.abs(errors), axis=1)
+        if loss == 'mae':
+            return np.nanmean(np.abs(errors), axis=1)
+        if loss == 'rmse':
+            return np.sqrt(np.nanmean(errors**2, axis=1))
+        raise ValueError(f'Unknown loss "{loss}". Choose one of "median", "mae" or "rmse"')
+
+
+def evaluate_chunk(chunk, params):
+    """
+    Returns the (parameter sets, rides) array of the average estimated power of each ride of a @chunk of concatenated
+    rides for the block of parameter sets in @params. This is module-level so that it can be sent to worker processes.
+    """
+    params = dict(params)
+    # The total mass of each point (parameter sets, points) comes from the rider mass and the bike of the point's ride
+    rider_mass = np.asarray(params['rider_mass'], dtype=float)
+    rider_mass = rider_mass.reshape(-1, 1) if rider_mass.ndim == 1 else rider_mass
+    params['total_mass'] = rider_mass + chunk['bike_weight'].reshape(1, -1)
+
+    inst_power = estimate_power(chunk['filt_speed'], chunk['filt_grade'], params, wind_velocity_component=chunk['wind'])
+    inst_power = np.atleast_2d(inst_power)
+
+    # Average each ride's points (ignoring NaN like the ride_avg_power aggregation)
+    is_valid = ~np.isnan(inst_power)
+    power_sums = np.add.reduceat(np.where(is_valid, inst_power, 0.0), chunk['ride_starts'], axis=1)
+    point_counts = np.add.reduceat(is_valid, chunk['ride_starts'], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(point_counts > 0, power_sums / point_counts, np.nan)
+
+def _build_chunk(chunk_rides):
+    # Concatenate the points of the @chunk_rides and remember where each ride starts
+    ride_lengths = [len(ride['filt_speed']) for ride in chunk_rides]
+    return {'filt_speed': np.concatenate([ride['filt_speed'] for ride in chunk_rides]),
+            'filt_grade': np.concatenate([ride['filt_grade'] for ride in chunk_rides]),
+            'wind': np.concatenate([ride['wind'] for ride in chunk_rides]),
+            'bike_weight': np.repeat([ride['bike_weight'] for ride in chunk_rides], ride_lengths).astype(float),
+            'ride_starts': np.cumsum([0] + ride_lengths[:-1])}
+
+def _select_block(params, param_sets, start, stop):
+    # The params with only the parameter sets [start, stop) of the swept params
+    block_params = dict(params)
+    block_params.update({name: np.asarray(values, dtype=float)[start:stop] for name, values in param_sets.items()})
+    return block_params
+
+################################################################
+# VERSIONED CALIBRATED PARAMS
+################################################################
+
+def save_calibrated_params(params, calibration_path, fit_details=None):
+    """
+    Writes the fitted @params as the next version of the calibrated power params:
+        <calibration_path>/power_estimation_params_v001.json, _v002.json, ...
+    Returns the version number that was written
+    """
+    if not isdir(calibration_path):
+        makedirs(calibration_path)
+    version = max(list_calibrated_versions(calibration_path), default=0) + 1
+    record = {'version': version, 'created': datetime.now().isoformat(timespec='seconds'),
+              'params': params, 'fit': fit_details if fit_details is not None else {}}
+    with open(join(calibration_path, f'power_estimation_params_v{version:03d}.json'), 'w') as opened_file:
+        json.dump(record, opened_file, indent=4, default=float)
+    return version
+
+def load_calibrated_params(calibration_path, version='latest'):
+    """
+    Returns the params of a @version of the calibrated power params ('latest' = the highest version)
+    """
+    versions = list_calibrated_versions(calibration_path)
+    if len(versions) == 0:
+        raise FileNotFoundError(f'There are no calibrated power params in {calibration_path}')
+    version = max(versions) if version == 'latest' else int(version)
+    with open(join(calibration_path, f'power_estimation_params_v{version:03d}.json'), 'r') as opened_file:
+        return json.load(opened_file)['params']
+
+def list_calibrated_versions(calibration_path):
+    if not isdir(calibration_path):
+        return []
+    file_names = [f for f in listdir(calibration_path) if f.startswith('power_estimation_params_v') and f.endswith('.json')]
+    return sorted(int(f[len('power_estimation_params_v'):-len('.json')]) for f in file_names)
@@ -1,11 +1,12 @@
-import pandas as pd
+from os import environ, cpu_count
 from os.path import join
 
 class Config():
     def __init__(self):
         # Store the absolute path of the project
         # This should be edited if working in a new environment after repo cloning
-        self.root_dir = 'C:/Users/Demo/Documents/Data_Science/Strava/strava-fitness/'
+        # (or set with the STRAVA_FITNESS_ROOT environment variable, e.g. by CLI_launch.py --root-dir)
+        self.root_dir = environ.get('STRAVA_FITNESS_ROOT', 'C:/Users/Demo/Documents/Data_Science/Strava/strava-fitness/')
 
 
     @property
@@ -32,16 +33,164 @@ class Config():
     def enriched_activity_log_path(self):
         return join(self.root_dir, 'data/cleaned/activity_log.csv')
 
+    @property
+    def best_power_curve_path(self):
+        # This holds the all-time and per training window best mean-max power curves (see utils/powercurve.py)
+        return join(self.root_dir, 'data/cleaned/power_curve.csv')
+
+    @property
+    def manifest_path(self):
+        # This records which rides each stage has already processed (see utils/manifest.py)
+        return join(self.root_dir, 'data/manifest.csv')
+
+    @property
+    def metrics_path(self):
+        # The per stage and per ride metrics of every run are appended here as JSON lines (see utils/instrument.py)
+        return join(self.root_dir, 'data/metrics/etl_metrics.jsonl')
+
+    @property
+    def profile_path(self):
+        # The per ride profiles of the stages are written here when a profiler is set
+        return join(self.root_dir, 'data/metrics/profiles/')
+
+    @property
+    def weather_observation_path(self):
+        # Weather observations (observation_time | wind_speed | wind_bearing) for the wind in the power estimation
+        # When this file doesn't exist, the weather observation of each ride in the Activity Log is used
+        return join(self.root_dir, 'data/processed/weather_observations.csv')
+
     @property
     def privacy_zone_path(self):
         # NOTE: this directory is in .gitignore
         return join(self.root_dir, 'data/cleaned/privacy/privacy_zones.csv')
 
+    @property
+    def ride_file_format(self):
+        # This is the file format the ride files are stored in: 'csv', 'parquet' or 'feather'
+        # Existing CSV ride files can be converted with MIGRATE_launch.py
+        return 'csv'
+
+    @property
+    def ride_dataset_path(self):
+        # This is the combined, partitioned dataset of every cleaned ride (see utils/dataset.py)
+        return join(self.root_dir, 'data/cleaned/dataset/')
+
+    @property
+    def ride_dataset_partition(self):
+        # The ride dataset is partitioned by 'training_window_id' or by 'month'
+        return 'training_window_id'
+
     @property
     def time_gap_threshold(self):
         # This is the number of seconds to create a new segment_id if delta_time >= threshold
         return 15 # seconds
 
+    @property
+    def cruising_speed_thresholds(self):
+        # A ride starts cruising once the speed reaches the upper threshold and stops once it drops below the lower one
+        return {'upper_cruising_threshold': 8, # MPH
+                'lower_cruising_threshold': 5  # MPH
+               }
+
+    @property
+    def training_calendar(self):
+        # Training window 0 starts on start_date and each window lasts period_days (see utils/training.py)
+        return {'start_date': '2020-01-02', # UTC
+                'period_days': 56, # 8 weeks
+                'n_windows': None # None = unlimited, rides past the last window get training_window_id -1
+               }
+
+    @property
+    def broadcast_training_window(self):
+        # True = also write each ride's training_window_id to its points (the ride dataset is partitioned by it)
+        # The Activity Log always gets the training_window_id of each ride
+        return True
+
+    @property
+    def signal_filter_params(self):
+        # The channels smoothed by the Hann window filter (each gets a 'filt_<channel>' column)
+        return {'channels': ['speed', 'grade'],
+                'window_order': 10, # points in the Hann window
+                'method': 'auto' # convolution method: 'auto', 'direct', 'fft' or 'oa' (overlap-add for long windows)
+               }
+
+    @property
+    def incremental(self):
+        # True = each stage only processes the rides that are new or whose inputs or params changed since the last run
+        return True
+
+    @property
+    def n_workers(self):
+        # This is the number of worker processes RideETL uses to process rides in parallel (1 = no parallelism)
+        # The default is one per CPU, set 1 to process the rides in the main process (e.g. to overlap the file I/O)
+        return cpu_count() or 1
+
+    @property
+    def chunk_size(self):
+        # This is the number of ride files handed to a worker process at a time
+        return 4
+
+    @property
+    def io_threads(self):
+        # Number of threads reading the next ride files and writing the last ones while a ride is processed (0 = no overlap)
+        # With n_workers > 1 each worker process overlaps the I/O of its chunk of rides, it also applies to the LogETL aggregations
+        return 0
+
+    @property
+    def prefetch_size(self):
+        # The most ride files waiting to be processed (and waiting to be written) at once, this caps the memory used
+        return 8
+
+    @property
+    def profiler(self):
+        # Profile the process step of every ride: None, 'cprofile' or 'pyinstrument' (needs the pyinstrument package)
+        return None
+
+    @property
+    def power_curve_durations(self):
+        # These are the durations (in seconds) of the mean-max power curve aggregated for each ride
+        return [1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 420, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200]
+
+    @property
+    def use_wind(self):
+        # True = add the headwind/tailwind from the weather observations to the drag force of the power estimation
+        return False
+
+    @property
+    def calibration_path(self):
+        # This holds the versioned power_estimation_params fitted by CALIBRATE_launch.py (see utils/calibration.py)
+        return join(self.root_dir, 'data/calibration/')
+
+    @property
+    def power_params_version(self):
+        # The version of the calibrated power params to use: None = the params below, 'latest' or a version number
+        return None
+
+    @property
+    def calibration_grid(self):
+        # The candidate values of the params fitted against the rides with a measured avg_power
+        return {'cda': [0.25, 0.30, 0.35, 0.40, 0.45, 0.50, 0.55, 0.60], # m^2, area * coefficient of drag
+                'mu_rr': [0.003, 0.004, 0.005, 0.006, 0.007, 0.008], # coefficient of rolling friction
+                'eta_dt': [0.94, 0.96, 0.98] # efficiency of drive train
+               }
+
+    @property
+    def benchmark_path(self):
+        # This holds the stored baseline of BENCHMARK_launch.py's stage benchmark (see utils/benchmark.py)
+        return join(self.root_dir, 'data/benchmarks/baseline.json')
+
+    @property
+    def benchmark_params(self):
+        # The shape of the synthetic rides the ETL stages are benchmarked on
+        return {'ride_lengths': [1000, 4000, 16000], # recorded points per ride (the scaling curve)
+                'sample_period': 1, # seconds between recorded points
+                'dropout': 0.1, # fraction of the points lost
+                'n_segments': 4, # segments separated by pauses
+                'n_privacy_zones': 50,
+                'n_aggregate_rides': 10, # ride files in the aggregate stage
+                'repeats': 3 # timed runs per stage (the best one is kept)
+               }
+
     @property
     def power_estimation_params(self):
         params = {'rider_mass': 86.1826, # kg
@@ -52,4 +201,8 @@ class Config():
                   'eta_dt': 0.96, # efficiency of drive train
                   'gravity': 9.8 # m/s^2
                  }
-        return params # seconds
\ No newline at end of file
+        if self.power_params_version is not None:
+            # Overlay the calibrated params (e.g. a fitted 'cda' is used instead of area * c_drag)
+            from utils.calibration import load_calibrated_params
+            params.update(load_calibrated_params(self.calibration_path, version=self.power_params_version))
+        return params
\ No newline at end of file
@@ -0,0 +1,213 @@
+import shutil
+import pandas as pd
+from tqdm import tqdm
+from os import makedirs
+from os.path import join, isfile
+
+from utils.extract import get_ride_id
+from utils.schema import apply_ride_schema
+from utils.storage import read_ride_file, _require_pyarrow
+
+class RideDataset():
+    """
+    The RideDataset combines every ride file into one columnar (Parquet) dataset that is partitioned by
+    'training_window_id' or by the 'month' a ride started in:
+        <dataset_path>/training_window_id=5/part.parquet
+
+    Each ride is kept whole in a single partition and is written as its own row group. The dataset's index
+    (<dataset_path>/index.csv) maps each ride_id to its partition, row group and row range:
+        ride_id | partition | file_name | row_group | row_start | row_stop
+
+    Queries only open the partition files they need, and reading single rides only reads their row groups.
+    This needs the optional pyarrow package.
+    """
+    partition_columns = ['training_window_id', 'month']
+    index_columns = ['ride_id', 'partition', 'file_name', 'row_group', 'row_start', 'row_stop']
+
+    def __init__(self, dataset_path, partition_by='training_window_id'):
+        if partition_by not in self.partition_columns:
+            raise ValueError(f'Unknown partition "{partition_by}". Choose one of {self.partition_columns}')
+        self.dataset_path = dataset_path
+        self.partition_by = partition_by
+        self.df_index = None
+        self.load_index()
+
+    @property
+    def index_path(self):
+        return join(self.dataset_path, 'index.csv')
+
+    @property
+    def partitions(self):
+        partitions = list(self.df_index['partition'].unique())
+        return sorted(partitions, key=int) if self.partition_by == 'training_window_id' else sorted(partitions)
+
+    def load_index(self):
+        if isfile(self.index_path):
+            self.df_index = pd.read_csv(self.index_path, dtype={'partition':str})
+        else:
+            self.df_index = pd.DataFrame(columns=self.index_columns)
+
+    ################################################################
+    # BUILD METHODS
+    ################################################################
+
+    def build(self, ride_files):
+        """
+        (Re)builds the whole dataset from the @ride_files (any supported ride file format)
+        """
+        _require_pyarrow('dataset')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        print(f'Building the {self.partition_by} partitioned ride dataset from {len(ride_files)} ride files')
+        # Start from an empty dataset directory
+        shutil.rmtree(self.dataset_path, ignore_errors=True)
+        makedirs(self.dataset_path)
+
+        # Each ride file is read once and appended to the file of its partition, in ride_id order
+        writers, row_counts, index_records = {}, {}, []
+        try:
+            for ride_file in tqdm(sorted(ride_files, key=lambda f: int(get_ride_id(f)))):
+                df = read_ride_file(ride_file)
+                partition = self._get_partition_value(df)
+                table = pa.Table.from_pandas(self._to_storage_dtypes(df), preserve_index=False)
+
+                file_name = join(f'{self.partition_by}={partition}', 'part.parquet')
+                if partition not in writers:
+                    makedirs(join(self.dataset_path, f'{self.partition_by}={partition}'))
+                    writers[partition] = pq.ParquetWriter(join(self.dataset_path, file_name), table.schema, compression='zstd')
+                elif not table.schema.equals(writers[partition].schema):
+                    raise ValueError(f'The columns of {ride_file} do not match the other rides of the dataset')
+
+                # A ride is written as a single row group so it can be read on its own
+                row_group, row_start = row_counts.get(partition, (0, 0))
+                writers[partition].write_table(table, row_group_size=max(table.num_rows, 1))
+                row_counts[partition] = (row_group+1, row_start+table.num_rows)
+                index_records.append({'ride_id':int(get_ride_id(ride_file)), 'partition':partition, 'file_name':file_name,
+                                      'row_group':row_group, 'row_start':row_start, 'row_stop':row_start+table.num_rows})
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        self.df_index = pd.DataFrame(data=index_records, columns=self.index_columns)
+        self.df_index = self.df_index.sort_values(['partition', 'row_group'], key=self._get_sort_key)
+        self.df_index.to_csv(self.index_path, index=False)
+        self.load_index()
+
+    ################################################################
+    # QUERY METHODS
+    ################################################################
+
+    def query(self, columns=None, filters=None, partitions=None, ride_ids=None) -> pd.DataFrame:
+        """
+        Returns the points of the dataset that match every condition:
+        @columns = the columns to return (None = every column)
+        @filters = list of (column, op, value) conditions, op is one of ==, !=, <, <=, >, >=, in, not in
+                   e.g. [('filt_grade', '>', 6)]. The conditions on the partition column are used to skip partitions.
+        @partitions = the partition values to read (None = every partition), e.g. [5] for training window 5
+        @ride_ids = only read the rows of these rides
+
+        e.g. all points in training window 5 with filt_grade > 6%:
+            dataset.query(filters=[('training_window_id', '==', 5), ('filt_grade', '>', 6)])
+        """
+        _require_pyarrow('dataset')
+        import pyarrow.parquet as pq
+
+        filters = [] if filters is None else list(filters)
+        df_index = self._prune_index(filters=filters, partitions=partitions, ride_ids=ride_ids)
+        # The partition conditions were applied by pruning (the month isn't a column of the rides)
+        point_filters = [f for f in filters if f[0] != 'month']
+
+        tables = []
+        for file_name, df_file_index in df_index.groupby('file_name', sort=False):
+            file_path = join(self.dataset_path, file_name)
+            if ride_ids is None:
+                # Parquet also skips the row groups whose statistics can't match the filters
+                tables.append(pq.read_table(file_path, columns=columns, filters=point_filters or None))
+                continue
+            read_columns = None if columns is None else columns + [f[0] for f in point_filters if f[0] not in columns]
+            table = pq.ParquetFile(file_path).read_row_groups(sorted(df_file_index['row_group']), columns=read_columns)
+            if len(point_filters) > 0:
+                table = table.filter(pq.filters_to_expression(point_filters))
+            tables.append(table.select(columns) if columns is not None else table)
+
+        if len(tables) == 0:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat([table.to_pandas() for table in tables], ignore_index=True)
+        return apply_ride_schema(df)
+
+    def read_ride(self, ride_id, columns=None) -> pd.DataFrame:
+        """
+        Returns a single ride's points, only its row group is read
+        """
+        if int(ride_id) not in set(self.df_index['ride_id']):
+            raise KeyError(f'Ride {ride_id} is not in the ride dataset {self.dataset_path}')
+        return self.query(columns=columns, ride_ids=[ride_id])
+
+    def get_row_range(self, ride_id):
+        """
+        Returns the (file_name, row_start, row_stop) of a ride within its partition file
+        """
+        record = self.df_index.loc[self.df_index['ride_id'] == int(ride_id)]
+        if record.shape[0] == 0:
+            raise KeyError(f'Ride {ride_id} is not in the ride dataset {self.dataset_path}')
+        record = record.iloc[0]
+        return record['file_name'], int(record['row_start']), int(record['row_stop'])
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    def _prune_index(self, filters, partitions, ride_ids):
+        # Keep only the index rows of the rides in the partitions that can match the query
+        df_index = self.df_index
+        if partitions is not None:
+            df_index = df_index.loc[df_index['partition'].isin([str(p) for p in partitions])]
+        if ride_ids is not None:
+            df_index = df_index.loc[df_index['ride_id'].isin([int(r) for r in ride_ids])]
+        for column, op, value in filters:
+            if column != self.partition_by:
+                continue
+            partition_values = df_index['partition'] if self.partition_by == 'month' else df_index['partition'].astype(int)
+            df_index = df_index.loc[_compare(partition_values, op, value)]
+        return df_index
+
+    def _get_sort_key(self, values):
+        # Sort the training windows by number instead of as text
+        if (values.name == 'partition') and (self.partition_by == 'training_window_id'):
+            return values.astype(int)
+        return values
+
+    def _get_partition_value(self, df):
+        # Rides are never split across partitions, a ride belongs to the partition of its first point
+        if self.partition_by == 'month':
+            return df['time'].iloc[0].strftime('%Y-%m')
+        return str(int(df[self.partition_by].iloc[0]))
+
+    @staticmethod
+    def _to_storage_dtypes(df):
+        # Store ride_id as a plain integer column so the rides of a partition share a single Parquet schema
+        df = df.copy()
+        if 'ride_id' in df.columns:
+            df['ride_id'] = df['ride_id'].astype('int64')
+        return df
+
+
+def _compare(values, op, value):
+    if op in ['=', '==']:
+        return values == value
+    if op == '!=':
+        return values != value
+    if op == '<':
+        return values < value
+    if op == '<=':
+        return values <= value
+    if op == '>':
+        return values > value
+    if op == '>=':
+        return values >= value
+    if op == 'in':
+        return values.isin(value)
+    if op == 'not in':
+        return ~values.isin(value)
+    raise ValueError(f'Unknown filter operator "{op}"')
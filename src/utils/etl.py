@@ -1,35 +1,84 @@
+import time
 import pandas as pd
+import traceback
 from tqdm import tqdm
-from os import listdir
-from os.path import isfile, join
+from os.path import join, isfile, getsize
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from utils.config import Config
 from utils.extract import *
+from utils.storage import get_ride_store, read_ride_file, list_ride_files
+from utils.manifest import RideManifest, hash_file, hash_params
+from utils.instrument import get_instrumentation, new_ride_metrics, measure_ride_step, get_peak_rss_mb
+from utils.overlap import map_bounded
+from utils.stages import RIDE_STAGES, parse_stage_names
+from utils.training import TrainingCalendar
+from utils.metadata import get_ride_metadata
+from utils.weather import get_weather_table
+from utils.schema import apply_ride_schema
+from utils.pandaswindow import SegmentWindow
+from utils.powercurve import compute_mean_max_curve, get_curve_column, get_best_power_curves, update_best_power_curves
 from utils.transform.clean import *
 from utils.transform.enrich import *
 from utils.transform.convert import *
 from utils.transform.normalize import *
 
 class LogETL():
-    def __init__(self):
+    def __init__(self, incremental=None, instrumentation=None, io_threads=None):
         self.config = Config()
+        self.ride_store = get_ride_store(self.config.ride_file_format)
         self.ride_files = None
         self.df_log = None
+        self.aggregations = []
+        # ride_ids re-aggregated by the latest incremental pass (None = every ride was aggregated)
+        self.aggregated_ride_ids = None
+        # When incremental, only the rides whose ride file changed since the last run are re-aggregated
+        self.incremental = self.config.incremental if incremental is None else incremental
+        self.manifest = RideManifest(self.config.manifest_path) if self.incremental else None
+        # Number of threads reading the next ride files while the current one is aggregated (0 = no prefetch)
+        self.io_threads = self.config.io_threads if io_threads is None else io_threads
+        self.prefetch_size = self.config.prefetch_size
+        # Records the read/aggregate time, rows and memory of each ride (None = the Config's metrics file, see utils/instrument.py)
+        self.instrumentation = instrumentation
 
     def run_pipeline(self):
         # Load Data
         self.load_ride_file_paths()
         self.load_activity_log()
-        # Apply Aggregations
+        # Aggregate the Ride Files into the Activity Log
+        self.run_aggregations()
+        # Save Enriched Activity Log
+        self.save_activity_log()
+        self.save_best_power_curves()
+        if self.incremental == True:
+            self.manifest.save()
+
+    def run_aggregations(self):
+        """
+        Registers the default aggregations, applies them to self.ride_files in a single pass (only the new or 
+        changed rides when incremental) and assigns the training windows of the aggregated rides to self.df_log.
+        The ride files and the Activity Log must already be loaded.
+        """
+        self.register_default_aggregations()
+        # Apply every registered Aggregation in a single pass over the ride files
+        if self.incremental == True:
+            self.apply_incremental_aggregations()
+        else:
+            self.apply_aggregations()
+        # Assign the Training Windows from the aggregated start times
+        self._get_training_window()
+
+    def register_default_aggregations(self):
+        # Register every aggregation of the enriched Activity Log (in the order of its columns)
         self._get_ride_time_endpoints()
         self._get_row_segment_counts()
         self._get_elapsed_durations()
         self._get_speed_summary()
-        self._get_training_window()
         self._get_basic_power_summary()
         self._get_power_ftp()
-        # Save Enriched Activity Log
-        self.save_activity_log()
+        self._get_power_curve()
 
     ############################################################################################
     # AGGREGATE
@@ -43,8 +92,8 @@ class LogETL():
             agg_dict = {'start_time':start_time, 'end_time':end_time}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_time_endpoints)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_time_endpoints, columns=['time'])
 
     def _get_row_segment_counts(self):
         # Define the Aggregation function to apply
@@ -54,8 +103,8 @@ class LogETL():
             agg_dict = {'row_count':row_count, 'segment_count':segment_count}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_row_segment_counts)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_row_segment_counts, columns=['segment_id'])
 
     def _get_elapsed_durations(self):
         # Define the Aggregation function to apply
@@ -63,7 +112,7 @@ class LogETL():
             last_row = df.shape[0]-1
             elapsed_time = df.loc[last_row, 'elapsed_time']
             moving_time = df.loc[last_row, 'moving_time'] 
-            elapsed_distance = df['delta_dist'].cumsum().iloc[last_row]
+            elapsed_distance = df['delta_dist'].astype('float64').cumsum().iloc[last_row]
             elapsed_ascent = df.loc[last_row, 'elapsed_ascent']
             elapsed_descent = df.loc[last_row, 'elapsed_descent']
             elapsed_elevation = df.loc[last_row, 'elapsed_elevation']
@@ -72,8 +121,8 @@ class LogETL():
                         'elapsed_ascent':elapsed_ascent, 'elapsed_descent':elapsed_descent, 'elapsed_elevation':elapsed_elevation}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_durations)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_durations, columns=['elapsed_time', 'moving_time', 'delta_dist', 'elapsed_ascent', 'elapsed_descent', 'elapsed_elevation'])
 
     def _get_speed_summary(self):
         # Define the Aggregation function to apply
@@ -88,19 +137,16 @@ class LogETL():
             agg_dict = {'ride_avg_speed':ride_avg_speed, 'ride_cruise_speed':ride_cruise_speed, 'ride_max_speed':ride_max_speed}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_speed_summary)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_speed_summary, columns=['speed', 'is_cruising', 'filt_speed'])
 
     def _get_training_window(self):
-        # Define the Aggregation function to apply
-        def get_training_window_id(df):
-            training_window_id =  df.loc[0, 'training_window_id']
-            
-            agg_dict = {'training_window_id':training_window_id}
-            return agg_dict
-
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_training_window_id)
+        """
+        Assigns the training window of every ride from its start_time, in a single pass over the Activity Log
+        (the training windows don't need the ride files, so this runs after the aggregations instead of being one)
+        """
+        calendar = TrainingCalendar(**self.config.training_calendar)
+        self.df_log['training_window_id'] = calendar.get_window_ids(self.df_log['start_time'])
 
     def _get_basic_power_summary(self):
         # Define the Aggregation function to apply
@@ -111,31 +157,53 @@ class LogETL():
             agg_dict = {'ride_avg_power':ride_avg_power, 'ride_max_power':ride_max_power}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_basic_power_summary)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_basic_power_summary, columns=['inst_power'])
 
     def _get_power_ftp(self):
         # Define the Aggregation function to apply
         def get_power_ftp(df):
-            # 1200 corresponds to 1200 samples at 1 sec/sample for 20 minutes
-            power_window = df['inst_power'].rolling(window=1200).mean()
-            peak_20min_power = np.max(power_window)
+            # Rolling 20 minute (1200 sec) mean power over the elapsed time of each segment, so no window spans a pause
+            window = SegmentWindow(partition_by='segment_id', order_by='time')
+            df = window.partition(df)
+            power_window = window.rolling_mean(df['inst_power'].values, df['time'], window_seconds=1200)
+            peak_20min_power = pd.Series(power_window).max()
             
             agg_dict = {'peak_20min_power':peak_20min_power}
             return agg_dict
 
-        # Apply the Aggregation
-        self.apply_aggregation(agg_func=get_power_ftp)
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_power_ftp, columns=['time', 'segment_id', 'inst_power'])
+
+    def _get_power_curve(self):
+        durations = self.config.power_curve_durations
+
+        # Define the Aggregation function to apply
+        def get_power_curve(df):
+            # Mean-maximal power for every duration over the elapsed time of each segment
+            window = SegmentWindow(partition_by='segment_id', order_by='time')
+            df = window.partition(df)
+            curve = compute_mean_max_curve(df['inst_power'].values, durations, times=df['time'], window=window)
+            
+            agg_dict = {get_curve_column(duration):power for duration, power in zip(durations, curve)}
+            return agg_dict
+
+        # Register the Aggregation
+        self.register_aggregation(agg_func=get_power_curve, columns=['time', 'segment_id', 'inst_power'], 
+                                  params={'durations': durations})
 
     ############################################################################################
     # HELPERS
     ############################################################################################
+    def _get_instrumentation(self):
+        if self.instrumentation is None:
+            self.instrumentation = get_instrumentation(self.config.metrics_path, profiler=self.config.profiler, 
+                                                       profile_path=self.config.profile_path)
+        return self.instrumentation
+
     def load_ride_file_paths(self):
         input_rides_path = self.config.cleaned_ride_path
-        ride_files = listdir(input_rides_path) # get all files and directories
-        ride_files = [join(input_rides_path, f) for f in ride_files if f != '.gitignore'] # add full paths to files
-        ride_files = [f for f in ride_files if isfile(f)] # get only files, no directories
-        self.ride_files = ride_files
+        self.ride_files = list_ride_files(input_rides_path, extension=self.ride_store.extension)
 
     def load_activity_log(self):
         log_path = self.config.activity_log_path
@@ -145,67 +213,294 @@ class LogETL():
     def save_activity_log(self):
         enriched_log_path = self.config.enriched_activity_log_path
         self.df_log.to_csv(enriched_log_path, index=False)
+
+    def save_best_power_curves(self):
+        """
+        Saves the all-time and per training window best mean-max power curves built from the rides' power curves.
+        When only new rides were aggregated, they are merged into the previously saved best curves.
+        """
+        durations = self.config.power_curve_durations
+        curve_path = self.config.best_power_curve_path
+        if get_curve_column(durations[0]) not in self.df_log.columns:
+            return # the power curve aggregation didn't run
+
+        df_best = pd.read_csv(curve_path) if (self.aggregated_ride_ids is not None) and isfile(curve_path) else None
+        if df_best is not None:
+            # The previous best curves can only be updated when none of their rides changed or went away
+            unchanged_ride_ids = set(self.df_log['ride_id']) - set(self.aggregated_ride_ids)
+            is_updatable = set(df_best['ride_id']).issubset(unchanged_ride_ids) and set(df_best['duration']) == set(durations)
+            df_best = df_best if is_updatable else None
+
+        if df_best is None:
+            df_best = get_best_power_curves(self.df_log, durations)
+        else:
+            df_new_log = self.df_log.loc[self.df_log['ride_id'].isin(self.aggregated_ride_ids)]
+            df_best = update_best_power_curves(df_best, df_new_log, durations)
+        df_best.to_csv(curve_path, index=False)
     
-    def apply_aggregation(self, agg_func):
-        # Initialize the Aggregation results list
-        agg_results = []
+    def register_aggregation(self, agg_func, columns=None, params=None):
+        """
+        Adds @agg_func to the registry of aggregations that apply_aggregations() runs over each ride file.
+        The @agg_func takes a ride's dataframe and returns a dictionary of {column_name: value}
 
-        function_name = agg_func.__name__
-        print(f'Applying the "{function_name}" aggregation across {len(self.ride_files)} CSV ride files.')
-        # Run the Aggregation over each Ride File
-        for ride_file in tqdm(self.ride_files):
-            # Read the Ride File
-            df = read_ride_csv(ride_file)
+        @columns = the ride columns that @agg_func reads. Only the columns needed by the registered aggregations
+                   are loaded from each ride file (None = @agg_func needs every column)
+        @params = dictionary of the settings @agg_func was built with, a change in params re-aggregates every ride
+        """
+        self.aggregations.append((agg_func, columns, params))
+
+    def apply_aggregation(self, agg_func, columns=None, params=None):
+        # Run a single aggregation on its own pass over the ride files
+        self.apply_aggregations(aggregations=[(agg_func, columns, params)])
 
-            # Apply the Aggregation
-            agg_dict = agg_func(df)
+    def apply_aggregations(self, aggregations=None):
+        """
+        Reads each ride file once, runs every (agg_func, columns, params) in @aggregations (default: the registered aggregations)
+        against it and merges all of the results into the Activity Log at once.
+        """
+        if aggregations is None:
+            aggregations = self.aggregations
+            self.aggregations = [] # the registered aggregations are consumed by this pass
+        if len(aggregations) == 0:
+            return
+
+        df_agg = self._aggregate_ride_files(ride_files=self.ride_files, aggregations=aggregations)
+        self.aggregated_ride_ids = None
+
+        self.df_log = self.df_log.merge(df_agg, on='ride_id', how='inner')
+
+    def apply_incremental_aggregations(self):
+        """
+        Like apply_aggregations() for the registered aggregations, except only the rides that are new, whose ride file
+        changed or that were aggregated with a different set of aggregations are read. The aggregation results of every
+        other ride are carried over from the previous enriched Activity Log.
+        """
+        aggregations = self.aggregations
+        self.aggregations = [] # the registered aggregations are consumed by this pass
+        if len(aggregations) == 0:
+            return
+        params_hash = hash_params([(agg_func.__name__, columns, params) for agg_func, columns, params in aggregations])
+
+        # Load the results of the previous run (if any)
+        enriched_log_path = self.config.enriched_activity_log_path
+        df_previous = pd.read_csv(enriched_log_path) if isfile(enriched_log_path) else pd.DataFrame(columns=['ride_id'])
+        previous_ride_ids = set(df_previous['ride_id'].values)
+
+        # Find the rides that need to be aggregated again
+        dirty_files, clean_ride_ids, input_hashes = [], [], {}
+        for ride_file in self.ride_files:
+            ride_id = get_ride_id(ride_file)
+            input_hashes[ride_id] = hash_file(ride_file)
+            is_dirty = self.manifest.is_dirty(ride_id, 'aggregate', input_hashes[ride_id], params_hash)
+            if is_dirty or (int(ride_id) not in previous_ride_ids):
+                dirty_files.append(ride_file)
+            else:
+                clean_ride_ids.append(int(ride_id))
+        print(f'{len(dirty_files)} of {len(self.ride_files)} ride files are new or changed since the last aggregation.')
+
+        # Aggregate the dirty rides and carry over the aggregation columns of the clean rides
+        df_agg = self._aggregate_ride_files(ride_files=dirty_files, aggregations=aggregations)
+        self.aggregated_ride_ids = [int(get_ride_id(ride_file)) for ride_file in dirty_files]
+        agg_columns = [col for col in df_previous.columns if col not in self.df_log.columns]
+        df_carried = df_previous.loc[df_previous['ride_id'].isin(clean_ride_ids), ['ride_id']+agg_columns]
+        df_agg = pd.concat([df for df in [df_agg, df_carried] if df.shape[0] > 0], ignore_index=True)
+
+        self.df_log = self.df_log.merge(df_agg, on='ride_id', how='inner')
+
+        # Record the rides that were aggregated in this run
+        for ride_file in dirty_files:
             ride_id = get_ride_id(ride_file)
-            agg_dict['ride_id'] = int(ride_id)
+            self.manifest.record(ride_id, 'aggregate', input_hash=input_hashes[ride_id], params_hash=params_hash,
+                                 output_path=enriched_log_path, output_hash=input_hashes[ride_id])
+
+    def _aggregate_ride_files(self, ride_files, aggregations):
+        """
+        Runs every (agg_func, columns, params) in @aggregations against each of the @ride_files (each file is read once)
+        Returns a dataframe with one row of aggregation results per ride
+        """
+        agg_funcs = [agg_func for agg_func, _, _ in aggregations]
+        columns = self._get_aggregation_columns(aggregations)
+
+        # Initialize the Aggregation results list
+        agg_results = []
 
-            # Append the results
-            agg_results.append(agg_dict)
+        function_names = ', '.join([f'"{agg_func.__name__}"' for agg_func in agg_funcs])
+        print(f'Applying the {function_names} aggregation(s) across {len(ride_files)} ride files.')
+        instrumentation = self._get_instrumentation()
+        instrumentation.start_stage('aggregate', n_rides=len(ride_files))
+        profile_path = instrumentation.get_stage_profile_path('aggregate')
+
+        def read_ride(ride_file):
+            ride_metrics = new_ride_metrics(get_ride_id(ride_file))
+            ride_metrics['substage_seconds'] = {}
+            with measure_ride_step(ride_metrics, 'read'):
+                df = read_ride_file(ride_file, columns=columns)
+            ride_metrics['rows_in'] = df.shape[0]
+            return ride_metrics, df
+
+        # Read the Ride Files (ahead of the aggregations when there are I/O threads)
+        reader = ThreadPoolExecutor(max_workers=self.io_threads) if self.io_threads > 0 else None
+        if reader is not None:
+            read_rides = map_bounded(reader, read_ride, ride_files, max_pending=self.prefetch_size)
+        else:
+            read_rides = map(read_ride, ride_files)
+
+        # Run the Aggregations over each Ride File
+        try:
+            for ride_metrics, df in tqdm(read_rides, total=len(ride_files)):
+                # Apply each Aggregation to the same loaded ride
+                agg_dict = {'ride_id':ride_metrics['ride_id']}
+                with measure_ride_step(ride_metrics, 'process', instrumentation.profiler, profile_path):
+                    for agg_func in agg_funcs:
+                        agg_start = time.perf_counter()
+                        agg_dict.update(agg_func(df))
+                        ride_metrics['substage_seconds'][agg_func.__name__] = time.perf_counter() - agg_start
+                ride_metrics['rows_out'] = 1
+                ride_metrics['peak_rss_mb'] = get_peak_rss_mb()
+                instrumentation.record_ride('aggregate', ride_metrics)
+
+                # Append the results
+                agg_results.append(agg_dict)
+        finally:
+            if reader is not None:
+                reader.shutdown(cancel_futures=True)
+        instrumentation.end_stage('aggregate')
 
         # Created aggregation results dataframe
-        df_agg = pd.DataFrame(data=agg_results)
+        df_agg = pd.DataFrame(data=agg_results, columns=['ride_id'] if len(agg_results) == 0 else None)
+        return df_agg
 
-        self.df_log = self.df_log.merge(df_agg, on='ride_id', how='inner')
+    @staticmethod
+    def _get_aggregation_columns(aggregations):
+        # Returns the union of the ride columns the @aggregations read (None = every column)
+        columns = []
+        for _, agg_columns, _ in aggregations:
+            if agg_columns is None:
+                return None
+            columns += [col for col in agg_columns if col not in columns]
+        return columns
 
-            
 
 
 class RideETL():
-    def __init__(self):
+    def __init__(self, n_workers=None, chunk_size=None, incremental=None, instrumentation=None, io_threads=None, ride_ids=None):
         self.config = Config()
+        self.ride_store = get_ride_store(self.config.ride_file_format)
+        # Number of worker processes used by apply_process (1 = run in the main process)
+        self.n_workers = self.config.n_workers if n_workers is None else n_workers
+        # Number of ride files sent to a worker process at a time
+        self.chunk_size = self.config.chunk_size if chunk_size is None else chunk_size
+        # Number of reader and of writer threads overlapping the file I/O with the processing (0 = no overlap)
+        self.io_threads = self.config.io_threads if io_threads is None else io_threads
+        self.prefetch_size = self.config.prefetch_size
+        # Rides that raised an error during the most recent apply_process
+        self.failed_rides = []
+        # The calendar of the training windows, built when a stage first needs it
+        self.training_calendar = None
+        # Only these ride_ids are processed by the stages (None = every ride)
+        self.ride_ids = None if ride_ids is None else [int(ride_id) for ride_id in ride_ids]
+        # When incremental, a stage only processes the rides that are new or whose input or stage params changed
+        self.incremental = self.config.incremental if incremental is None else incremental
+        self.manifest = RideManifest(self.config.manifest_path) if self.incremental else None
+        # Records the read/process/write time, rows, bytes and memory of each ride of each stage
+        # (None = the Config's metrics file, see utils/instrument.py)
+        self.instrumentation = instrumentation
 
     def run_pipeline(self):
         """
         This is the high-level interface method to run the ETL pipeline in its correct sequence
+        When incremental, each stage skips the rides it has already processed with the same input and params
         """
-        #self.extract_gpx_to_csv()
-        #self.normalize_time_sampling()
-        #self.basic_enrichment()
-        #self.protect_privacy_zones()
-        #self.filter_noise()
+        self.extract_gpx_to_csv()
+        self.normalize_time_sampling()
+        self.basic_enrichment()
+        self.protect_privacy_zones()
+        self.filter_noise()
         self.estimate_ride_power()
 
+    def run_stages(self, stage_names):
+        """
+        Runs only the @stage_names (e.g. ['normalize', 'enrich']) in the pipeline's order, see utils/stages.py
+        """
+        for stage_name in parse_stage_names(stage_names):
+            method_name, _ = RIDE_STAGES[stage_name]
+            getattr(self, method_name)()
+
+    def run_fused_pipeline(self, include_extract=False, checkpoint_stages=None):
+        """
+        This runs the TRANSFORM stages (normalize -> enrich -> privacy -> filter -> power) back to back on one in-memory 
+        dataframe per ride. Each ride is read once and only the final result is written to the Config's Cleaned_Ride_Path.
+
+        @include_extract = True to start from the raw GPX files instead of the extracted ride files
+        @checkpoint_stages = list of stage names (e.g. ['normalize', 'privacy']) whose intermediate output should still be
+                             written to the same location the staged pipeline writes it to
+        """
+        if checkpoint_stages is None:
+            checkpoint_stages = []
+
+        # Gather the details of each stage in the order that they run
+        stage_details = [self._normalize_time_sampling_details(),
+                         self._basic_enrichment_details(),
+                         self._protect_privacy_zones_details(),
+                         self._filter_noise_details(),
+                         self._estimate_ride_power_details()]
+        first_stage_details = stage_details[0]
+        if include_extract == True:
+            first_stage_details = self._extract_gpx_to_csv_details()
+            stage_details = [first_stage_details] + stage_details
+
+        # Build the chain of (stage_name, process_func, checkpoint_path) to run on each ride
+        stages = []
+        stage_params = {details['stage_name']: details['params'] for details in stage_details}
+        for details in stage_details:
+            checkpoint_path = details['output_path'] if details['stage_name'] in checkpoint_stages else None
+            stages.append((details['stage_name'], details['process_func'], checkpoint_path))
+        process_func = partial(process_fused_stages, stages=stages, ride_store=self.ride_store)
+
+        # Define the details of the process
+        process_details_dict = {'stage_name': 'fused',
+                                'upstream_stage': first_stage_details['upstream_stage'],
+                                'params': stage_params,
+                                'invalidated_stages': [name for name in stage_params.keys() if name != 'extract'],
+                                'process_func': process_func,
+                                'extract_func': first_stage_details['extract_func'],
+                                'input_extension': first_stage_details['input_extension'],
+                                'ride_store': self.ride_store,
+                                'input_path': first_stage_details['input_path'],
+                                'output_path': self.config.cleaned_ride_path,
+                                'filter_valid': first_stage_details['filter_valid'],
+                                'description_template': 'Running the fused ride pipeline on {} ride files'
+                                }
+
+        self.apply_process(process_details_dict=process_details_dict)
+
     ############################################################################################
     # EXTRACT
     ############################################################################################
 
     def extract_gpx_to_csv(self):
         """
-        This method converts all valid raw GPX files found in the Config's Raw_Ride_Path into .CSV files
+        This method converts all valid raw GPX files found in the Config's Raw_Ride_Path into ride files
+        (.CSV files unless the Config's Ride_File_Format says otherwise)
         """
+        self.apply_process(process_details_dict=self._extract_gpx_to_csv_details())
+
+    def _extract_gpx_to_csv_details(self):
         # Define the details of the process
-        process_details_dict = {'process_func': None,
+        process_details_dict = {'stage_name': 'extract',
+                                'upstream_stage': None,
+                                'params': {},
+                                'process_func': None,
                                 'extract_func': read_gpx_to_dataframe,
+                                'input_extension': None,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.raw_ride_path,
                                 'output_path': self.config.extracted_ride_path,
                                 'filter_valid': True,
-                                'description_template': 'Extracting {} GPX ride files to CSV'
+                                'description_template': 'Extracting {} GPX ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
     
     ############################################################################################
@@ -215,115 +510,169 @@ class RideETL():
     ### NORMALIZATION
 
     def normalize_time_sampling(self):
+        self.apply_process(process_details_dict=self._normalize_time_sampling_details())
+
+    def _normalize_time_sampling_details(self):
         # Define the process function
         threshold = self.config.time_gap_threshold
-        def process_normalize_time(df, time_gap_threshold=threshold):
-            normalizer = TimeNormalizer(df=df, time_gap_threshold=time_gap_threshold)
-            normalizer.run()
-
-            return normalizer.df_upsampled
+        process_func = partial(process_normalize_time, time_gap_threshold=threshold)
 
         # Define the details of the process
-        process_details_dict = {'process_func': process_normalize_time,
-                                'extract_func': read_ride_csv,
+        process_details_dict = {'stage_name': 'normalize',
+                                'upstream_stage': 'extract',
+                                'params': {'time_gap_threshold': threshold},
+                                'process_func': process_func,
+                                'extract_func': read_ride_file,
+                                'input_extension': self.ride_store.extension,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.extracted_ride_path,
                                 'output_path': self.config.enriched_ride_path,
                                 'filter_valid': False,
-                                'description_template': 'Normalizing the time sampling for {} CSV ride files'
+                                'description_template': 'Normalizing the time sampling for {} ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
     ### ENRICHMENT
 
     def basic_enrichment(self):
-        # Define the process function
-        def process_basic_enrichment(df):
-            enricher = BasicEnricher(df=df)
-            enricher.run()
+        self.apply_process(process_details_dict=self._basic_enrichment_details())
 
-            return enricher.df
+    def _basic_enrichment_details(self):
+        # Define the process function
+        cruising_thresholds = self.config.cruising_speed_thresholds
+        # The training windows are only written to the ride points when they are broadcast
+        training_calendar = self._get_training_calendar() if self.config.broadcast_training_window else None
+        process_func = partial(process_basic_enrichment, cruising_thresholds=cruising_thresholds, 
+                               training_calendar=training_calendar)
 
         # Define the details of the process
-        process_details_dict = {'process_func': process_basic_enrichment,
-                                'extract_func': read_ride_csv,
+        process_details_dict = {'stage_name': 'enrich',
+                                'upstream_stage': 'normalize',
+                                'params': {'cruising_thresholds': cruising_thresholds, 
+                                           'training_calendar': None if training_calendar is None else training_calendar.params},
+                                'process_func': process_func,
+                                'extract_func': read_ride_file,
+                                'input_extension': self.ride_store.extension,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.enriched_ride_path,
                                 'output_path': self.config.enriched_ride_path,
                                 'filter_valid': False,
-                                'description_template': 'Performing basic enrichments on {} CSV ride files'
+                                'description_template': 'Performing basic enrichments on {} ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
     def estimate_ride_power(self):
+        self.apply_process(process_details_dict=self._estimate_ride_power_details())
+
+    def _estimate_ride_power_details(self):
         # Define the process function
         calc_params = self.config.power_estimation_params
-        log_path = self.config.activity_log_path
-        def process_estimate_power(df, calc_params=calc_params, activity_log_path=log_path):
-            estimator = PowerEstimator(df=df, calc_params=calc_params, activity_log_path=activity_log_path)
-            estimator.run()
-
-            return estimator.df
+        # Load the activity log lookup once per run, it is sent along to the worker processes
+        ride_metadata = get_ride_metadata(self.config.activity_log_path)
+        # Load the weather observations once per run when the wind is part of the power estimation
+        weather_table, weather_hash = None, None
+        if self.config.use_wind == True:
+            weather_path, time_column = self.config.weather_observation_path, 'observation_time'
+            if not isfile(weather_path):
+                # Fall back on the weather observation of each ride in the Activity Log
+                weather_path, time_column = self.config.activity_log_path, 'weather_observation_time'
+            weather_table = get_weather_table(weather_path, time_column=time_column)
+            weather_hash = hash_file(weather_path)
+        process_func = partial(process_estimate_power, calc_params=calc_params, ride_metadata=ride_metadata, 
+                               weather_table=weather_table)
 
         # Define the details of the process
-        process_details_dict = {'process_func': process_estimate_power,
-                                'extract_func': read_ride_csv,
+        process_details_dict = {'stage_name': 'power',
+                                'upstream_stage': 'filter',
+                                'params': {'calc_params': calc_params, 'use_wind': self.config.use_wind, 
+                                           'weather_hash': weather_hash},
+                                'process_func': process_func,
+                                'extract_func': read_ride_file,
+                                'input_extension': self.ride_store.extension,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.cleaned_ride_path,
                                 'output_path': self.config.cleaned_ride_path,
                                 'filter_valid': False,
-                                'description_template': 'Estimating ride power for {} CSV ride files'
+                                'description_template': 'Estimating ride power for {} ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
     ### PRIVACY
 
     def protect_privacy_zones(self):
+        self.apply_process(process_details_dict=self._protect_privacy_zones_details())
+
+    def _protect_privacy_zones_details(self):
         # Define the process function
+        # Load the privacy zones once per run instead of once per ride
         privacy_zones_file_path = self.config.privacy_zone_path
-        def process_protect_privacy(df, privacy_zone_path=privacy_zones_file_path):
-            protector = PrivacyZoner(df=df, privacy_zone_path=privacy_zone_path)
-            protector.run()
-
-            return protector.df
+        df_privacy = load_privacy_zones(privacy_zones_file_path) if isfile(privacy_zones_file_path) else None
+        process_func = partial(process_protect_privacy, df_privacy=df_privacy, privacy_zone_path=privacy_zones_file_path)
+        # Changing the privacy zones needs every ride to be protected again
+        privacy_zones_hash = hash_file(privacy_zones_file_path) if isfile(privacy_zones_file_path) else None
 
         # Define the details of the process
-        process_details_dict = {'process_func': process_protect_privacy,
-                                'extract_func': read_ride_csv,
+        process_details_dict = {'stage_name': 'privacy',
+                                'upstream_stage': 'enrich',
+                                'params': {'privacy_zones_hash': privacy_zones_hash},
+                                'process_func': process_func,
+                                'extract_func': read_ride_file,
+                                'input_extension': self.ride_store.extension,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.enriched_ride_path,
                                 'output_path': self.config.cleaned_ride_path,
                                 'filter_valid': False,
-                                'description_template': 'Removing sensitive location PII on {} CSV ride files'
+                                'description_template': 'Removing sensitive location PII on {} ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
 
     ### CLEANING
 
     def filter_noise(self):
-        # Define the process function
-        def process_filter_noise(df):
-            filterer = SignalFilter(df=df)
-            filterer.run()
+        self.apply_process(process_details_dict=self._filter_noise_details())
 
-            return filterer.df
+    def _filter_noise_details(self):
+        # Define the process function
+        filter_params = self.config.signal_filter_params
+        process_func = partial(process_filter_noise, filter_params=filter_params)
 
         # Define the details of the process
-        process_details_dict = {'process_func': process_filter_noise,
-                                'extract_func': read_ride_csv,
+        process_details_dict = {'stage_name': 'filter',
+                                'upstream_stage': 'privacy',
+                                'params': {'filter_params': filter_params},
+                                'process_func': process_func,
+                                'extract_func': read_ride_file,
+                                'input_extension': self.ride_store.extension,
+                                'ride_store': self.ride_store,
                                 'input_path': self.config.cleaned_ride_path,
                                 'output_path': self.config.cleaned_ride_path,
                                 'filter_valid': False,
-                                'description_template': 'Filtering noisy speed and grade on {} CSV ride files'
+                                'description_template': 'Filtering noisy speed and grade on {} ride files'
                                 } 
 
-        self.apply_process(process_details_dict=process_details_dict)
+        return process_details_dict
 
     ############################################################################################
     # HELPERS
     ############################################################################################
 
+    def _get_instrumentation(self):
+        if self.instrumentation is None:
+            self.instrumentation = get_instrumentation(self.config.metrics_path, profiler=self.config.profiler, 
+                                                       profile_path=self.config.profile_path)
+        return self.instrumentation
+
+    def _get_training_calendar(self):
+        # Built once per run and shared by every ride
+        if self.training_calendar is None:
+            self.training_calendar = TrainingCalendar(**self.config.training_calendar)
+        return self.training_calendar
+
     def _select_valid_rides(self, file_names):
         """
         Given a list of @file_names of potential ride files, this method refers to the processed Activity Log.
@@ -335,7 +684,7 @@ class RideETL():
 
         # Build the @file_names into a dataframe of "ride_id" | "file_name" columns
         data = [{'ride_id':int(get_ride_id(ride_file)), 'file_name':ride_file} for ride_file in file_names]
-        df_files = pd.DataFrame(data=data)
+        df_files = pd.DataFrame(data=data, columns=['ride_id', 'file_name'])
 
         # Subset the ride_ids that appear in df_log_valid
         df_valid = df_log_valid.merge(df_files, on='ride_id', how='inner')
@@ -344,44 +693,272 @@ class RideETL():
         valid_file_names = list(df_valid['file_name'].values)
         return valid_file_names
 
+    def _select_dirty_rides(self, ride_files, process_details_dict):
+        """
+        Returns the @ride_files that the stage in @process_details_dict needs to (re)process,
+        along with the input hash of every ride file by ride_id
+        """
+        stage_name = process_details_dict['stage_name']
+        params_hash = hash_params(process_details_dict['params'])
+
+        dirty_files, input_hashes = [], {}
+        for ride_file in ride_files:
+            ride_id = get_ride_id(ride_file)
+            input_hashes[ride_id] = self.manifest.get_input_hash(ride_id, ride_file, process_details_dict['upstream_stage'])
+            if self.manifest.is_dirty(ride_id, stage_name, input_hashes[ride_id], params_hash):
+                dirty_files.append(ride_file)
+
+        print(f'{len(dirty_files)} of {len(ride_files)} ride files are new or changed since the "{stage_name}" stage last ran')
+        return dirty_files, input_hashes
+
+    def _record_processed_rides(self, results, input_hashes, process_details_dict):
+        # Record each successfully processed ride in the manifest
+        stage_name = process_details_dict['stage_name']
+        params_hash = hash_params(process_details_dict['params'])
+        for result in results:
+            if result['error'] is not None:
+                continue
+            ride_id = result['ride_id']
+            self.manifest.record(ride_id, stage_name, input_hash=input_hashes[ride_id], params_hash=params_hash,
+                                 output_path=result['output_file'])
+            # Forget the stages whose output files were just overwritten so they run again when used on their own
+            for invalidated_stage in process_details_dict.get('invalidated_stages', []):
+                self.manifest.invalidate(ride_id, invalidated_stage)
+        self.manifest.save()
+
     def apply_process(self, process_details_dict):
         """
-        process_details_dict = {'process_func': function object for specific process to run,
+        process_details_dict = {'stage_name': short name of the stage (e.g. 'normalize'),
+                                'upstream_stage': stage_name of the stage that writes the input files (None = no stage)
+                                'params': dictionary of the stage's params, a change in params re-runs every ride
+                                'invalidated_stages': (optional) stage_names whose output this stage overwrites
+                                'process_func': function object for specific process to run,
                                 'extract_func': function object for the extraction step
+                                'input_extension': only the input files ending in this extension are processed (None = all)
+                                'ride_store': RideStore object that writes the output ride files
                                 'input_path': input path to extract from
                                 'output_path': output path to load to
                                 'filter_valid': True/False of whether to use _select_valid_rides
                                 'description_template': string template to fill out and print when running
                                 }
+
+        When self.n_workers > 1 the rides are processed by a pool of worker processes, so 'process_func' and
+        'extract_func' must be picklable (module-level functions or functools.partial objects of them).
+        When self.io_threads > 0 the ride files are read ahead and written behind by threads while 'process_func' 
+        runs (see process_ride_files_overlapped), in this process or else in each worker process for its chunk
+        of self.chunk_size rides.
+        Rides are always processed and reported in sorted file order, and a ride that raises an error is
+        recorded in self.failed_rides instead of stopping the rest of the rides.
+        The metrics of every ride and of the stage are handed to self.instrumentation.
         """
         # Get the list of activity files
         input_rides_path = process_details_dict['input_path']
-        ride_files = listdir(input_rides_path) # get all files and directories
-        ride_files = [join(input_rides_path, f) for f in ride_files if f != '.gitignore'] # add full paths to files
-        ride_files = [f for f in ride_files if isfile(f)] # get only files, no directories
+        ride_files = list_ride_files(input_rides_path, extension=process_details_dict['input_extension'])
 
         # Filter the activity files for only the valid ones
         if process_details_dict['filter_valid'] == True:
             ride_files = self._select_valid_rides(ride_files)
 
+        # Only keep the selected rides
+        if self.ride_ids is not None:
+            ride_ids = set(self.ride_ids)
+            ride_files = [ride_file for ride_file in ride_files if int(get_ride_id(ride_file)) in ride_ids]
+
+        # Sort the files so the processing order doesn't depend on the file system
+        ride_files = sorted(ride_files)
+
+        # Only keep the rides that are new or changed since this stage last processed them
+        if self.incremental == True:
+            ride_files, input_hashes = self._select_dirty_rides(ride_files, process_details_dict)
+
         # Print Process Description
         print('-'*100)
         process_description = process_details_dict['description_template'].format(len(ride_files))
         print(process_description)
 
-        # Run the Process over each Ride File
-        for ride_file in tqdm(ride_files):
-            # Read the Ride File
-            df = process_details_dict['extract_func'](ride_file)
+        # The rides measure themselves (in the worker processes too), the profiler settings travel with the details
+        stage_name = process_details_dict['stage_name']
+        instrumentation = self._get_instrumentation()
+        instrumentation.start_stage(stage_name, n_rides=len(ride_files))
+        process_details_dict = dict(process_details_dict, profiler=instrumentation.profiler,
+                                    profile_path=instrumentation.get_stage_profile_path(stage_name))
 
-            # Apply the Process (if any specified)
+        # Run the Process over each Ride File
+        if (self.n_workers > 1) and (self.io_threads > 0):
+            # Each worker process overlaps the reading and writing of its chunk of rides with their processing
+            chunks = [ride_files[i:i+self.chunk_size] for i in range(0, len(ride_files), self.chunk_size)]
+            process_chunk = partial(process_ride_files_overlapped, process_details_dict=process_details_dict,
+                                    io_threads=self.io_threads, max_pending=self.prefetch_size, show_progress=False)
+            results = []
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor, tqdm(total=len(ride_files)) as progress:
+                # executor.map yields the chunks in the same order as ride_files
+                for chunk_results in executor.map(process_chunk, chunks):
+                    results.extend(chunk_results)
+                    progress.update(len(chunk_results))
+        elif self.n_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                # executor.map yields the results in the same order as ride_files
+                results = executor.map(process_ride_file, ride_files, repeat(process_details_dict), 
+                                       chunksize=self.chunk_size)
+                results = list(tqdm(results, total=len(ride_files)))
+        elif self.io_threads > 0:
+            # Overlap the reading and writing of the ride files with the processing in this process
+            results = process_ride_files_overlapped(ride_files, process_details_dict, io_threads=self.io_threads, 
+                                                    max_pending=self.prefetch_size)
+        else:
+            results = [process_ride_file(ride_file, process_details_dict) for ride_file in tqdm(ride_files)]
+
+        for result in results:
+            instrumentation.record_ride(stage_name, result['metrics'])
+        instrumentation.end_stage(stage_name)
+
+        # Record the rides that were processed
+        if self.incremental == True:
+            self._record_processed_rides(results, input_hashes, process_details_dict)
+
+        # Report any rides that failed
+        self.failed_rides = [result for result in results if result['error'] is not None]
+        if len(self.failed_rides) > 0:
+            print(f'{len(self.failed_rides)} of {len(ride_files)} ride files failed:')
+            for failed_ride in self.failed_rides:
+                print(f'    {failed_ride["ride_file"]}: {failed_ride["error"]}')
+
+
+############################################################################################
+# PROCESS FUNCTIONS
+# These live at the module level so that they can be sent to worker processes
+############################################################################################
+
+def process_normalize_time(df, time_gap_threshold):
+    normalizer = TimeNormalizer(df=df, time_gap_threshold=time_gap_threshold)
+    normalizer.run()
+
+    return normalizer.df_upsampled
+
+def process_basic_enrichment(df, cruising_thresholds, training_calendar=None):
+    enricher = BasicEnricher(df=df, training_calendar=training_calendar, **cruising_thresholds)
+    enricher.run()
+
+    return enricher.df
+
+def process_estimate_power(df, calc_params, ride_metadata, weather_table=None):
+    estimator = PowerEstimator(df=df, calc_params=calc_params, ride_metadata=ride_metadata, weather_table=weather_table)
+    estimator.run()
+
+    return estimator.df
+
+def process_protect_privacy(df, df_privacy, privacy_zone_path):
+    protector = PrivacyZoner(df=df, privacy_zone_path=privacy_zone_path, df_privacy=df_privacy)
+    protector.run()
+
+    return protector.df
+
+def process_filter_noise(df, filter_params):
+    filterer = SignalFilter(df=df, **filter_params)
+    filterer.run()
+
+    return filterer.df
+
+def process_fused_stages(df, stages, ride_store):
+    """
+    Runs each (stage_name, process_func, checkpoint_path) in @stages on the same in-memory ride @df.
+    A stage's output is written with @ride_store to its checkpoint_path when one is given (None = no checkpoint)
+    """
+    ride_id = int(df['ride_id'].iloc[0])
+    for stage_name, process_func, checkpoint_path in stages:
+        if process_func is not None:
+            df = apply_ride_schema(process_func(df))
+        if checkpoint_path is not None:
+            ride_store.write(df, output_path=checkpoint_path, ride_id=ride_id)
+    return df
+
+def process_ride_file(ride_file, process_details_dict):
+    """
+    Runs the extract -> process -> write steps of @process_details_dict for a single @ride_file.
+
+    Any error is caught and returned so that one bad ride doesn't stop the others.
+    Returns a dictionary of {'ride_file', 'ride_id', 'output_file', 'error', 'traceback', 'metrics'} where 'error' is None
+    on success and 'metrics' holds the ride's read/process/write times, rows, bytes written and peak RSS
+    """
+    ride = read_ride_step(ride_file, process_details_dict)
+    ride = transform_ride_step(ride, process_details_dict)
+    ride = write_ride_step(ride, process_details_dict)
+    return finish_ride_step(ride)
+
+def process_ride_files_overlapped(ride_files, process_details_dict, io_threads, max_pending, show_progress=True):
+    """
+    Same as running process_ride_file() on each of the @ride_files, except the ride files are read ahead by
+    @io_threads reader threads and written behind by @io_threads writer threads, so the processing of a ride
+    overlaps the reading of the next rides and the writing of the last ones.
+
+    At most @max_pending rides wait to be processed and at most @max_pending rides wait to be written, so the
+    memory stays bounded. The results (and the errors) come back in the order of the @ride_files.
+    @show_progress = False in the worker processes, the main process shows the progress of every worker
+    """
+    read_step = partial(read_ride_step, process_details_dict=process_details_dict)
+    write_step = partial(write_ride_step, process_details_dict=process_details_dict)
+    with ThreadPoolExecutor(max_workers=io_threads) as reader, ThreadPoolExecutor(max_workers=io_threads) as writer:
+        # The chain is pulled from the end: each ride that is written makes room to process the next read ride
+        read_rides = map_bounded(reader, read_step, ride_files, max_pending)
+        processed_rides = (transform_ride_step(ride, process_details_dict) for ride in read_rides)
+        written_rides = map_bounded(writer, write_step, processed_rides, max_pending)
+        written_rides = tqdm(written_rides, total=len(ride_files)) if show_progress else written_rides
+        return [finish_ride_step(ride) for ride in written_rides]
+
+def read_ride_step(ride_file, process_details_dict):
+    # Read the Ride File
+    ride = {'ride_file':ride_file, 'ride_id':get_ride_id(ride_file), 'df':None, 'output_file':None, 
+            'error':None, 'traceback':None}
+    ride['metrics'] = new_ride_metrics(ride['ride_id'])
+    try:
+        with measure_ride_step(ride['metrics'], 'read'):
+            ride['df'] = process_details_dict['extract_func'](ride_file)
+        ride['metrics']['rows_in'] = ride['df'].shape[0]
+    except Exception as error:
+        _record_ride_error(ride, error)
+    return ride
+
+def transform_ride_step(ride, process_details_dict):
+    # Apply the Process (if any specified)
+    if ride['error'] is not None:
+        return ride
+    try:
+        with measure_ride_step(ride['metrics'], 'process', process_details_dict.get('profiler'), 
+                               process_details_dict.get('profile_path')):
+            df = ride['df']
             process = process_details_dict['process_func']
             if process is not None:
                 df = process(df)
 
-            # Build the new file name for PROCESSED data
-            ride_id = get_ride_id(ride_file)
-            new_file_name = join(process_details_dict['output_path'], (str(ride_id)+'.csv'))
-
-            # Write the Ride's CSV file
-            df.to_csv(new_file_name, index=False)
\ No newline at end of file
+            # Every stage writes its output with the dtypes of the ride schema
+            ride['df'] = apply_ride_schema(df)
+        ride['metrics']['rows_out'] = ride['df'].shape[0]
+    except Exception as error:
+        _record_ride_error(ride, error)
+    return ride
+
+def write_ride_step(ride, process_details_dict):
+    # Write the Ride's file
+    if ride['error'] is not None:
+        return ride
+    try:
+        with measure_ride_step(ride['metrics'], 'write'):
+            ride['output_file'] = process_details_dict['ride_store'].write(ride['df'], ride_id=ride['ride_id'],
+                                                                           output_path=process_details_dict['output_path'])
+        ride['metrics']['bytes_written'] = getsize(ride['output_file'])
+    except Exception as error:
+        _record_ride_error(ride, error)
+    return ride
+
+def finish_ride_step(ride):
+    # Release the ride's dataframe and return its result
+    ride.pop('df')
+    ride['metrics']['peak_rss_mb'] = get_peak_rss_mb()
+    return ride
+
+def _record_ride_error(ride, error):
+    ride['df'] = None
+    ride['output_file'] = None
+    ride['error'] = repr(error)
+    ride['traceback'] = traceback.format_exc()
+    ride['metrics']['error'] = repr(error)
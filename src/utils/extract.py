@@ -1,38 +1,74 @@
+import gzip
 import pandas as pd
-import gpxpy as gx
+import xml.etree.ElementTree as ET
+from array import array
+
+from utils.schema import apply_ride_schema, get_csv_dtypes
 
 def read_gpx_to_dataframe(file_path:str)->pd.DataFrame:
     """
-    Given a fully qualified @file_path, this function utilizes the gpxpy
-    package to parse the Track Point data from the XML structure.
+    Given a fully qualified @file_path of a .gpx file (or a gzip-compressed .gpx.gz export), this function 
+    streams the Track Point data out of the XML structure.
+
+    Each track point's lat/lon/ele/time goes straight into typed arrays and the parsed XML elements are
+    thrown away as it goes, so memory stays bounded even for very large files.
 
     This returns a Pandas dataframe of the GPX file
     """
     # Extract the ride ID from the file_path
-    ride_id = get_ride_id(file_path=file_path)
-
-    # Setup data capture as lists initially
-    data = []
-
-    # Open up the .gpx file and gather each point of data
-    with open(file_path,'r') as opened_file:
-        # parse the .gpx file into a GPX object
-        gpx = gx.parse(opened_file)
-        
-        # iterate through all tracks, segments and points to extract the data
-        for i, track in enumerate(gpx.tracks):
-            for j, segment in enumerate(track.segments):
-                for point in segment.points:
-                    # create the row of data & append to data
-                    row = {'ride_id':ride_id, 'segment_id':-1, 'time':point.time, 
-                        'elevation':point.elevation, 'latitude':point.latitude, 'longitude':point.longitude}
-                    data.append(row)
+    ride_id = int(get_ride_id(file_path=file_path))
+
+    # Setup data capture as typed arrays (the timestamps get converted all at once at the end)
+    latitudes, longitudes, elevations = array('d'), array('d'), array('d')
+    times = []
+
+    # Open up the .gpx file and stream through its points of data
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with opener(file_path, 'rb') as opened_file:
+        parent = None # the element holding the track points (the <trkseg>)
+        for event, element in ET.iterparse(opened_file, events=('start', 'end')):
+            tag = _get_local_name(element.tag)
+            if event == 'start':
+                if tag == 'trkseg':
+                    parent = element
+                continue
+            if tag != 'trkpt':
+                continue
+
+            # capture the point's data
+            elevation, time = float('nan'), None
+            for child in element:
+                child_tag = _get_local_name(child.tag)
+                if (child_tag == 'ele') and child.text:
+                    elevation = float(child.text)
+                elif child_tag == 'time':
+                    time = child.text
+            latitudes.append(float(element.get('lat')))
+            longitudes.append(float(element.get('lon')))
+            elevations.append(elevation)
+            times.append(time)
+
+            # throw away the points that were already captured
+            if parent is not None:
+                parent.clear()
+            else:
+                element.clear()
     
     # Capture the data structure as a Pandas Dataframe
-    df = pd.DataFrame(data)
+    n_points = len(times)
+    df = pd.DataFrame({'ride_id': pd.Series(ride_id, index=range(n_points), dtype='int64'),
+                       'segment_id': pd.Series(-1, index=range(n_points), dtype='int64'),
+                       'time': pd.to_datetime(pd.Series(times, dtype=object), utc=True),
+                       'elevation': pd.Series(elevations, dtype='float64'),
+                       'latitude': pd.Series(latitudes, dtype='float64'),
+                       'longitude': pd.Series(longitudes, dtype='float64')})
 
     return df
 
+def _get_local_name(tag:str)->str:
+    # Remove the XML namespace, e.g. '{http://www.topografix.com/GPX/1/1}trkpt' -> 'trkpt'
+    return tag.rsplit('}', 1)[-1]
+
 def get_ride_id(file_path:str)->str:
     """
     This function extracts the ride ID from a file name and returns it as a string
@@ -43,18 +79,22 @@ def get_ride_id(file_path:str)->str:
 
     return ride_id
 
-def read_ride_csv(file_path:str, time_columns=['time'])->pd.DataFrame:
+def read_ride_csv(file_path:str, time_columns=['time'], columns=None)->pd.DataFrame:
     """
     This function loads in a ride's data from .CSV given a file path as a dataframe
 
     The state of the data (processed vs. enriched) doesn't matter as long
     as there is a 'time' column for the timestamp
+
+    When @columns is given, only those columns are parsed from the file.
+    The columns are returned with the dtypes of the ride schema (see utils/schema.py)
     """
-    # Read in the CSV file for the Ride
-    df = pd.read_csv(file_path)
+    # Read in the CSV file for the Ride (the float columns are parsed straight into their schema dtype)
+    df = pd.read_csv(file_path, usecols=columns, dtype=get_csv_dtypes(), float_precision='round_trip')
     
     # guarantee the timestamps are datetime objects
     for time_col in time_columns:
-        df[time_col] = pd.to_datetime(df[time_col])
+        if time_col in df.columns:
+            df[time_col] = pd.to_datetime(df[time_col])
 
-    return df
+    return apply_ride_schema(df)
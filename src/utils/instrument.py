@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+from os import makedirs, listdir
+from os.path import join, isdir, dirname
+from datetime import datetime
+
+class Instrumentation():
+    """
+    Collects the metrics of the ETL stages and hands each of them to every sink (e.g. a JsonLinesSink).
+
+    For each ride of a stage a 'ride' record holds:
+        stage | ride_id | read_seconds | process_seconds | write_seconds | rows_in | rows_out | bytes_written | peak_rss_mb | error
+    (plus the 'substage_seconds' of each part of the process step where a stage reports them, e.g. each aggregation)
+    and once the stage is done a 'stage' record sums them up (with the slowest rides), so that the stages and the
+    outlier rides that take up the time stand out. The ride metrics are measured where the ride is processed (see
+    measure_ride_step), so they are the same whether the rides run in the main process or in worker processes.
+
+    The @profiler ('cprofile' or 'pyinstrument') optionally profiles the process step of every ride. Each ride's
+    profile is written to <profile_path>/<stage>/<ride_id>.prof (or .html), and the cProfile profiles of a stage are
+    merged into <profile_path>/<stage>.prof when the stage ends.
+    """
+    profilers = [None, 'cprofile', 'pyinstrument']
+
+    def __init__(self, sinks=None, profiler=None, profile_path=None, n_slowest=5):
+        """
+        Inputs:
+        @sinks = list of objects with an emit(record) method that receive every record (None = no sinks)
+        @profiler = None, 'cprofile' or 'pyinstrument' (pyinstrument is an optional package)
+        @profile_path = directory the profiles are written to (needed when a @profiler is set)
+        @n_slowest = number of slowest rides listed in a stage record
+        """
+        if profiler not in self.profilers:
+            raise ValueError(f'Unknown profiler "{profiler}". Choose one of {self.profilers}')
+        if (profiler is not None) and (profile_path is None):
+            raise ValueError(f'The "{profiler}" profiler needs a profile_path to write the profiles to')
+        self.sinks = [] if sinks is None else list(sinks)
+        self.profiler = profiler
+        self.profile_path = profile_path
+        self.n_slowest = n_slowest
+        self.run_id = datetime.now().isoformat(timespec='seconds')
+        self._stages = {} # stage_name -> {'start': perf_counter, 'rides': [ride records]}
+
+    def get_stage_profile_path(self, stage_name):
+        # The directory of a stage's per ride profiles (None = no profiling)
+        return None if self.profiler is None else join(self.profile_path, stage_name)
+
+    ################################################################
+    # INTERFACE METHODS
+    ################################################################
+
+    def start_stage(self, stage_name, n_rides):
+        self._stages[stage_name] = {'start': time.perf_counter(), 'n_rides': n_rides, 'rides': []}
+        if self.profiler is not None:
+            makedirs(self.get_stage_profile_path(stage_name), exist_ok=True)
+
+    def record_ride(self, stage_name, ride_metrics):
+        """
+        Emits the @ride_metrics (see new_ride_metrics) of one of the rides of @stage_name
+        """
+        record = {'event': 'ride', 'run_id': self.run_id, 'stage': stage_name}
+        record.update(ride_metrics)
+        self._stages[stage_name]['rides'].append(record)
+        self._emit(record)
+
+    def end_stage(self, stage_name):
+        """
+        Emits the summary record of @stage_name and returns it
+        """
+        stage = self._stages.pop(stage_name)
+        rides = stage['rides']
+        record = {'event': 'stage', 'run_id': self.run_id, 'stage': stage_name,
+                  'wall_seconds': time.perf_counter() - stage['start'], 'n_rides': stage['n_rides'],
+                  'n_failed': sum(ride['error'] is not None for ride in rides)}
+        for field in ['read_seconds', 'process_seconds', 'write_seconds', 'rows_in', 'rows_out', 'bytes_written']:
+            record[field] = sum(ride[field] for ride in rides if ride.get(field) is not None)
+        substage_seconds = {}
+        for ride in rides:
+            for substage, seconds in ride.get('substage_seconds', {}).items():
+                substage_seconds[substage] = substage_seconds.get(substage, 0.0) + seconds
+        if len(substage_seconds) > 0:
+            record['substage_seconds'] = substage_seconds
+        peak_rss = [ride['peak_rss_mb'] for ride in rides if ride.get('peak_rss_mb') is not None]
+        record['peak_rss_mb'] = max(peak_rss) if len(peak_rss) > 0 else None
+        slowest = sorted(rides, key=_get_ride_seconds, reverse=True)[:self.n_slowest]
+        record['slowest_rides'] = [{'ride_id': ride['ride_id'], 'seconds': _get_ride_seconds(ride)} for ride in slowest]
+        if self.profiler == 'cprofile':
+            record['profile_file'] = merge_cprofile_stats(self.get_stage_profile_path(stage_name),
+                                                          join(self.profile_path, f'{stage_name}.prof'))
+        self._emit(record)
+        return record
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    def _emit(self, record):
+        for sink in self.sinks:
+            sink.emit(record)
+
+
+def get_instrumentation(metrics_path, profiler=None, profile_path=None):
+    """
+    Returns the default Instrumentation: every record is appended to @metrics_path and the stage records are printed
+    """
+    return Instrumentation(sinks=[JsonLinesSink(metrics_path), PrintSink()], profiler=profiler, profile_path=profile_path)
+
+
+class JsonLinesSink():
+    """
+    Appends every record as one line of JSON to @metrics_path, e.g. to load a run's metrics with:
+        pd.read_json(metrics_path, lines=True)
+    """
+    def __init__(self, metrics_path):
+        self.metrics_path = metrics_path
+
+    def emit(self, record):
+        if dirname(self.metrics_path):
+            makedirs(dirname(self.metrics_path), exist_ok=True)
+        with open(self.metrics_path, 'a') as opened_file:
+            opened_file.write(json.dumps(record, default=str) + '\n')
+
+
+class PrintSink():
+    """
+    Prints the stage records (the ride records are left to the other sinks)
+    """
+    def emit(self, record):
+        if record['event'] != 'stage':
+            return
+        slowest = ', '.join(f'{ride["ride_id"]} ({ride["seconds"]:.2f}s)' for ride in record['slowest_rides'])
+        print(f'"{record["stage"]}" took {record["wall_seconds"]:.1f}s for {record["n_rides"]} rides '
+              f'(read {record["read_seconds"]:.1f}s, process {record["process_seconds"]:.1f}s, write {record["write_seconds"]:.1f}s), '
+              f'slowest rides: {slowest}')
+
+
+################################################################
+# RIDE MEASUREMENTS
+# These run where the ride is processed, which can be a worker process
+################################################################
+
+def new_ride_metrics(ride_id):
+    return {'ride_id': int(ride_id), 'read_seconds': None, 'process_seconds': None, 'write_seconds': None,
+            'rows_in': None, 'rows_out': None, 'bytes_written': None, 'peak_rss_mb': None, 'error': None}
+
+class measure_ride_step():
+    """
+    Context manager adding the wall time of one step ('read', 'process' or 'write') of a ride to its @ride_metrics.
+    The process step is profiled when a @profile_path is given.
+
+        with measure_ride_step(ride_metrics, 'read'):
+            df = extract_func(ride_file)
+    """
+    def __init__(self, ride_metrics, step, profiler=None, profile_path=None):
+        self.ride_metrics = ride_metrics
+        self.step = step
+        self.profiler = profiler if profile_path is not None else None
+        self.profile_path = profile_path
+        self._profile = None
+
+    def __enter__(self):
+        self._profile = _start_profile(self.profiler)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        seconds = time.perf_counter() - self._start
+        key = f'{self.step}_seconds'
+        self.ride_metrics[key] = (self.ride_metrics[key] or 0.0) + seconds
+        if self._profile is not None:
+            _stop_profile(self._profile, self.profiler, join(self.profile_path, str(self.ride_metrics['ride_id'])))
+        return False
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident memory (MB) this process has used so far, None where it can't be measured.
+    This is a high-water mark: within a stage, the ride whose peak_rss_mb jumps is the one that raised it.
+    """
+    try:
+        import resource
+    except ImportError:
+        # e.g. on Windows, fall back to the optional psutil package
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / 1e6
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak_rss / 1e6 if sys.platform == 'darwin' else peak_rss / 1e3
+
+def merge_cprofile_stats(ride_profile_path, merged_file):
+    """
+    Merges the per ride cProfile profiles of @ride_profile_path into @merged_file (None when there are none)
+    """
+    if not isdir(ride_profile_path):
+        return None
+    profile_files = [join(ride_profile_path, f) for f in sorted(listdir(ride_profile_path)) if f.endswith('.prof')]
+    if len(profile_files) == 0:
+        return None
+    stats = pstats.Stats(*profile_files)
+    stats.dump_stats(merged_file)
+    return merged_file
+
+def _start_profile(profiler):
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError('The "pyinstrument" profiler needs the pyinstrument package (pip install pyinstrument)')
+        profile = Profiler()
+        profile.start()
+        return profile
+    return None
+
+def _stop_profile(profile, profiler, file_stem):
+    if profiler == 'cprofile':
+        profile.disable()
+        profile.dump_stats(file_stem + '.prof')
+    else:
+        profile.stop()
+        with open(file_stem + '.html', 'w') as opened_file:
+            opened_file.write(profile.output_html())
+
+def _get_ride_seconds(ride):
+    return sum(ride[f'{step}_seconds'] or 0.0 for step in ['read', 'process', 'write'])
@@ -0,0 +1,111 @@
+import json
+import hashlib
+import pandas as pd
+from os import getpid, replace
+from os.path import isfile
+
+class RideManifest():
+    """
+    The RideManifest records, for each ride and stage, what the stage last ran on:
+        ride_id | stage_name | input_hash | params_hash | output_path | output_hash
+
+    A ride is "dirty" for a stage (and needs to be processed again) when the stage has never run on it,
+    when the content of its input or the params of the stage changed, or when its output file is missing.
+
+    Several stages read and write the same directory, so a stage's input file is often overwritten by later stages.
+    To avoid seeing those files as changed, the input_hash of a stage is the output_hash its upstream stage recorded
+    when it wrote the file. The input file itself is only hashed when the upstream stage has no record.
+
+    The RideETL and the LogETL can run at the same time with their own RideManifest of the same file, so save() only
+    writes this manifest's own changes on top of the records currently on disk, instead of overwriting them.
+    """
+    columns = ['ride_id', 'stage_name', 'input_hash', 'params_hash', 'output_path', 'output_hash']
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.records = {} # (ride_id, stage_name) -> record dictionary
+        self.changes = {} # (ride_id, stage_name) -> record dictionary (None = invalidated) since the last save
+        self.load()
+
+    def load(self):
+        self.records = self._read_records()
+        self.changes = {}
+
+    def save(self):
+        # Merge this manifest's changes into the records on disk (e.g. saved by another pipeline since this one loaded)
+        records = self._read_records()
+        for key, record in self.changes.items():
+            if record is None:
+                records.pop(key, None)
+            else:
+                records[key] = record
+        self.records = records
+        self.changes = {}
+
+        df_manifest = pd.DataFrame(data=list(self.records.values()), columns=self.columns)
+        df_manifest = df_manifest.sort_values(['ride_id', 'stage_name'])
+        # Write a temporary file and rename it, so a reader never sees a partially written manifest
+        temp_path = f'{self.manifest_path}.{getpid()}.tmp'
+        df_manifest.to_csv(temp_path, index=False)
+        replace(temp_path, self.manifest_path)
+
+    def _read_records(self):
+        if not isfile(self.manifest_path):
+            return {}
+        df_manifest = pd.read_csv(self.manifest_path, dtype={'ride_id':str})
+        return {(record['ride_id'], record['stage_name']): record for record in df_manifest.to_dict(orient='records')}
+
+    ################################################################
+    # INTERFACE METHODS
+    ################################################################
+
+    def get_input_hash(self, ride_id, ride_file, upstream_stage=None):
+        """
+        Returns the content hash of the @ride_file that a stage is about to read
+        """
+        upstream_record = self.records.get((str(ride_id), upstream_stage))
+        if (upstream_record is not None) and (upstream_record['output_path'] == ride_file):
+            return upstream_record['output_hash']
+        return hash_file(ride_file)
+
+    def is_dirty(self, ride_id, stage_name, input_hash, params_hash):
+        record = self.records.get((str(ride_id), stage_name))
+        if record is None:
+            return True # new ride for this stage
+        if (record['input_hash'] != input_hash) or (record['params_hash'] != params_hash):
+            return True # the input or the stage params changed
+        if not isfile(record['output_path']):
+            return True # the output went missing
+        return False
+
+    def record(self, ride_id, stage_name, input_hash, params_hash, output_path, output_hash=None):
+        if output_hash is None:
+            output_hash = hash_file(output_path)
+        key = (str(ride_id), stage_name)
+        self.records[key] = {'ride_id':str(ride_id), 'stage_name':stage_name,
+                             'input_hash':input_hash, 'params_hash':params_hash,
+                             'output_path':output_path, 'output_hash':output_hash}
+        self.changes[key] = self.records[key]
+
+    def invalidate(self, ride_id, stage_name):
+        key = (str(ride_id), stage_name)
+        self.records.pop(key, None)
+        self.changes[key] = None
+
+
+def hash_file(file_path, block_size=2**20):
+    """
+    Returns the SHA-1 hex digest of the content of @file_path
+    """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as opened_file:
+        for block in iter(lambda: opened_file.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def hash_params(params):
+    """
+    Returns a hex digest of a dictionary of stage @params (e.g. the power_estimation_params)
+    """
+    serialized_params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(serialized_params.encode('utf-8')).hexdigest()
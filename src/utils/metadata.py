@@ -0,0 +1,77 @@
+import pandas as pd
+from os.path import getmtime, getsize
+
+class RideMetadata():
+    """
+    Read-only lookup of the Activity Log's fields by ride_id (e.g. ride_id -> bike_weight).
+
+    The log is read once when the lookup is built instead of once per ride. The lookup only holds plain
+    dictionaries so it can be pickled and sent to worker processes, and it remembers the log file's
+    modification time and size so that a lookup of a log that has since changed can be detected and reloaded.
+    """
+    def __init__(self, activity_log_path, fields=None):
+        """
+        Inputs:
+        @activity_log_path = path to the Activity Log CSV with a 'ride_id' column
+        @fields = the log columns to keep (None = every column)
+        """
+        self.activity_log_path = activity_log_path
+        self.fields = fields
+        self._records = {}
+        self._file_signature = None
+        self._load()
+
+    def __contains__(self, ride_id):
+        return int(ride_id) in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, ride_id):
+        # Return a copy so that callers can't change the shared lookup
+        return dict(self._records[int(ride_id)])
+
+    def get(self, ride_id, field, default=None):
+        record = self._records.get(int(ride_id))
+        if record is None:
+            return default
+        return record.get(field, default)
+
+    def is_stale(self):
+        return self._file_signature != self._get_file_signature()
+
+    def refresh(self):
+        # Reload the lookup only if the Activity Log changed since it was loaded
+        if self.is_stale():
+            self._load()
+        return self
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    def _load(self):
+        self._file_signature = self._get_file_signature()
+        usecols = None if self.fields is None else ['ride_id'] + [f for f in self.fields if f != 'ride_id']
+        df_log = pd.read_csv(self.activity_log_path, usecols=usecols)
+        df_log['ride_id'] = df_log['ride_id'].astype('int64')
+        df_log = df_log.drop_duplicates(subset=['ride_id'], keep='last').set_index('ride_id')
+        self._records = df_log.to_dict(orient='index')
+
+    def _get_file_signature(self):
+        return (getmtime(self.activity_log_path), getsize(self.activity_log_path))
+
+
+# Lookups shared by everything in this process, by Activity Log path
+_ride_metadata_cache = {}
+
+def get_ride_metadata(activity_log_path, fields=None):
+    """
+    Returns the RideMetadata of @activity_log_path, only reading the file again when it changed since the last call
+    """
+    key = (activity_log_path, None if fields is None else tuple(fields))
+    ride_metadata = _ride_metadata_cache.get(key)
+    if ride_metadata is None:
+        ride_metadata = RideMetadata(activity_log_path, fields=fields)
+        _ride_metadata_cache[key] = ride_metadata
+    return ride_metadata.refresh()
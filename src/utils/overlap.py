@@ -0,0 +1,29 @@
+from collections import deque
+
+def map_bounded(executor, func, items, max_pending):
+    """
+    Lazily runs func(item) for each of the @items on the threads of @executor and yields the results in the same
+    order as the @items, e.g. to read the next rides while the current one is processed (prefetch) or to write the
+    last rides while the next one is processed (write-behind).
+
+    Backpressure: at most @max_pending items are submitted and not yet consumed, so no more than @max_pending results
+    (e.g. ride dataframes) are held in memory at once. The @items are only pulled from their iterator when there is
+    room, so chaining map_bounded() generators keeps every queue of the chain bounded.
+
+    Errors are deterministic: an exception raised by func(item) is raised here when the result of that item is
+    consumed, after the results of every earlier item. The items still pending are then cancelled.
+    """
+    if max_pending < 1:
+        raise ValueError(f'max_pending must be at least 1, got {max_pending}')
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        # Only reached early on an error or when the consumer stops, don't start the reads/writes left in the queue
+        for future in pending:
+            future.cancel()
@@ -1,9 +1,11 @@
+import numpy as np
 import pandas as pd
 from typing import Callable, Dict, List, Optional, Any
 # Type Aliases
 Dataframe = pd.DataFrame
 Transform = Callable[[Dataframe], Dataframe] # f: Dataframe -> Dataframe
 Partition = Dict[Any, Dataframe]
+Array = np.ndarray
 
 class PandasWindow():
     def __init__(self, partition_by:str, order_by:str) -> None:
@@ -43,8 +45,292 @@ class PandasWindow():
         # Gather the various dataframes of each partition
         dataframes = [df_partition for df_partition in partition_dict.values()]
         df = pd.concat(dataframes)
-        # sort the rows by @sort_by
-        df = df.set_index(self.order_by).sort_index().reset_index()
+        # sort the rows by @sort_by (the sort is skipped when the rows are already in order)
+        if df[self.order_by].is_monotonic_increasing:
+            columns = [self.order_by] + [col for col in df.columns if col != self.order_by]
+            df = df[columns].reset_index(drop=True)
+        else:
+            df = df.set_index(self.order_by).sort_index().reset_index()
         return df
-        
+
+
+class SegmentWindow():
+    def __init__(self, partition_by:str, order_by:str) -> None:
+        """
+        A window engine for dataframes whose partitions are contiguous runs of rows once sorted by @order_by
+        (e.g. the 'segment_id' of a ride sorted by 'time').
+
+        Instead of building a copy of each partition, partition() sorts the dataframe once (only when it isn't
+        already in order) and precomputes the offsets where each partition starts. The segment-aware transforms
+        (shift/diff/cumsum/fill/convolve) and the time-indexed rolling aggregations (rolling_mean/rolling_max)
+        then work on whole NumPy arrays and reset at each partition boundary.
+
+        Inputs:
+        @partition_by = the name of the column to partition the dataframes by
+        @order_by = the name of the column the rows are ordered by
+        """
+        self.partition_by = partition_by
+        self.order_by = order_by
+        self.starts = None # row offset where each partition starts
+        self.ends = None # row offset where each partition ends (exclusive)
+        self.is_start = None # True on the first row of each partition
+        self.partition_rank = None # 0, 1, 2... number of the partition that each row belongs to
+        self.is_reordered = False # True when partition() had to regroup rows that were in order
+
+    def partition(self, df:Dataframe) -> Dataframe:
+        """
+        Returns @df with its rows in order (sorting only when needed) and computes the partition boundaries.
+        The transforms below take arrays lined up with the returned dataframe's rows.
+        """
+        if not df[self.order_by].is_monotonic_increasing:
+            df = df.sort_values(self.order_by, kind='stable', ignore_index=True)
+
+        # A partition that shows up in more than one run of rows has to be regrouped
+        self.is_reordered = False
+        partition = df[self.partition_by].to_numpy()
+        self._set_boundaries(partition)
+        if len(self.starts) != len(pd.unique(partition)):
+            df = df.sort_values([self.partition_by, self.order_by], kind='stable', ignore_index=True)
+            self._set_boundaries(df[self.partition_by].to_numpy())
+            self.is_reordered = True
+        return df
+
+    def apply_func(self, df:Dataframe, func:Transform) -> Dataframe:
+        """
+        Same as PandasWindow.apply_func: applies @func to each partition and recombines them in @order_by order
+        """
+        df = self.partition(df)
+        dataframes = [func(df.iloc[start:end]) for start, end in zip(self.starts, self.ends)]
+        df = pd.concat(dataframes, ignore_index=True) if len(dataframes) > 0 else df
+        if self.is_reordered or not df[self.order_by].is_monotonic_increasing:
+            df = df.sort_values(self.order_by, kind='stable', ignore_index=True)
+        return df
+
+    ################################################################
+    # SEGMENT-AWARE TRANSFORMS
+    ################################################################
+
+    def shift(self, values:Array, periods:int=1, fill_value=np.nan) -> Array:
+        # Like Series.shift(@periods), except values never shift across a partition boundary
+        values = np.asarray(values)
+        shifted = np.full(values.shape, fill_value, dtype=np.result_type(values, np.asarray(fill_value)))
+        n = len(values)
+        if abs(periods) >= n:
+            return shifted
+        if periods > 0:
+            shifted[periods:] = values[:n-periods]
+            shifted[periods:][self.partition_rank[periods:] != self.partition_rank[:n-periods]] = fill_value
+        elif periods < 0:
+            shifted[:periods] = values[-periods:]
+            shifted[:periods][self.partition_rank[:periods] != self.partition_rank[-periods:]] = fill_value
+        else:
+            shifted[:] = values
+        return shifted
+
+    def diff(self, values:Array, periods:int=1) -> Array:
+        # Like Series.diff(@periods) per partition: the first row(s) of each partition are NaN
+        values = np.asarray(values, dtype=float)
+        return values - self.shift(values, periods=periods)
+
+    def cumsum(self, values:Array) -> Array:
+        # Like Series.cumsum() per partition: NaN values are skipped and stay NaN
+        values = np.asarray(values, dtype=float)
+        is_nan = np.isnan(values)
+        running_total = np.cumsum(np.where(is_nan, 0.0, values))
+        # Subtract the running total from before the start of each partition
+        total_before_start = running_total[self.starts] - np.where(is_nan, 0.0, values)[self.starts]
+        cumulative = running_total - total_before_start[self.partition_rank]
+        cumulative[is_nan] = np.nan
+        return cumulative
+
+    def ffill(self, values:Array) -> Array:
+        # Like Series.ffill() per partition (a 2D array of shape (rows, channels) is filled column by column)
+        values = np.asarray(values, dtype=float)
+        rows = self._broadcast_rows(np.arange(len(values)), values)
+        positions = np.where(np.isnan(values), -1, rows)
+        positions = np.maximum.accumulate(positions, axis=0) if len(values) > 0 else positions
+        # A position from an earlier partition means there is nothing to fill from
+        partition_starts = self._broadcast_rows(self.starts[self.partition_rank], values)
+        is_valid = (positions >= 0) & (positions >= partition_starts)
+        return np.where(is_valid, np.take_along_axis(values, np.clip(positions, 0, None), axis=0), np.nan)
+
+    def bfill(self, values:Array) -> Array:
+        # Like Series.bfill() per partition (a 2D array of shape (rows, channels) is filled column by column)
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        rows = self._broadcast_rows(np.arange(n), values)
+        positions = np.where(np.isnan(values), n, rows)
+        positions = np.flip(np.minimum.accumulate(np.flip(positions, axis=0), axis=0), axis=0) if n > 0 else positions
+        # A position from a later partition means there is nothing to fill from
+        partition_ends = self._broadcast_rows(self.ends[self.partition_rank], values)
+        is_valid = (positions < n) & (positions < partition_ends)
+        return np.where(is_valid, np.take_along_axis(values, np.clip(positions, None, n-1), axis=0), np.nan)
+
+    def convolve(self, values:Array, kernel:Array, method:str='auto') -> Array:
+        """
+        Same as scipy.signal.convolve(values_k, kernel, mode='same') run on each partition's values_k,
+        but done with a single convolution over all of the partitions.
+        A 2D array of @values of shape (rows, channels) convolves every channel with the @kernel at once.
+
+        The partitions are laid out with len(@kernel) zeros between them so the convolution resets at each boundary.
+        @method = 'direct', 'fft' or 'auto' (as in scipy.signal.convolve) or 'oa' for overlap-add (scipy.signal.oaconvolve),
+                  the FFT methods are faster for large kernels
+        """
+        values = np.asarray(values, dtype=float)
+        kernel = np.asarray(kernel, dtype=float)
+        m = len(kernel)
+        if len(values) == 0:
+            return values.copy()
+
+        # Place each partition after m zeros (plus m zeros at the end)
+        positions = np.arange(len(values)) + m * (self.partition_rank + 1)
+        padded = np.zeros((len(values) + m * (len(self.starts) + 1),) + values.shape[1:])
+        padded[positions] = values
+        kernel = kernel.reshape((m,) + (1,) * (values.ndim - 1)) # convolve along the rows only
+
+        # FFT methods spread a NaN across the whole signal instead of only across the kernel's reach
+        if np.isnan(values).any():
+            method = 'direct'
+        # scipy.signal is imported here since it is slow to import and only the signal filter convolves
+        from scipy import signal
+        if method == 'oa':
+            full = signal.oaconvolve(padded, kernel, mode='full', axes=0)
+        else:
+            full = signal.convolve(padded, kernel, mode='full', method=method)
+
+        # 'same' keeps the part of the full convolution centered on each original value
+        return full[positions + (m - 1)//2]
+
+    ################################################################
+    # TIME-INDEXED ROLLING AGGREGATIONS
+    ################################################################
+
+    def rolling_mean(self, values:Array, times:Array, window_seconds:float, weights:Optional[Array]=None, 
+                     min_coverage:Optional[float]=None) -> Array:
+        """
+        Trailing rolling mean over the last @window_seconds of elapsed time, i.e. over the rows of the same partition
+        with a time in (t - @window_seconds, t]. Windows never reach across a partition boundary (e.g. a pause 
+        between two segments), and the sums come from cumulative sums so each call is O(n).
+
+        @times = the time of each row, as datetimes or as seconds
+        @weights = the seconds each row covers (default: the time since the previous row of the partition, 
+                   1 second for the first row), the mean is weighted by them
+        @min_coverage = the seconds of (non-NaN) data a window must cover to get a value (default: @window_seconds,
+                        like rolling(window).mean() requiring a full window)
+        """
+        return self.rolling_mean_many(values, times, [window_seconds], weights=weights, min_coverage=min_coverage)[0]
+
+    def rolling_mean_many(self, values:Array, times:Array, windows:List[float], weights:Optional[Array]=None, 
+                          min_coverage:Optional[float]=None) -> Array:
+        """
+        rolling_mean over each of the @windows (seconds), returned as a (len(@windows), n) array. The seconds, 
+        the weights and the cumulative sums are computed once, so each window only adds a searchsorted for its 
+        starts and a difference of the cumulative sums.
+
+        @min_coverage = as in rolling_mean (default: each window's own length)
+        """
+        values = np.asarray(values, dtype=float)
+        seconds = self.to_seconds(times)
+        weights = self._get_time_weights(seconds) if weights is None else np.asarray(weights, dtype=float)
+
+        is_nan = np.isnan(values)
+        weighted_sums = np.concatenate([[0.0], np.cumsum(np.where(is_nan, 0.0, values * weights))])
+        coverage_sums = np.concatenate([[0.0], np.cumsum(np.where(is_nan, 0.0, weights))])
+        rows = np.arange(len(values))
+
+        rolling_means = np.full((len(windows), len(values)), np.nan)
+        for i, window_seconds in enumerate(windows):
+            window_starts = self._get_window_starts(seconds, window_seconds)
+            window_totals = weighted_sums[rows + 1] - weighted_sums[window_starts]
+            window_coverage = coverage_sums[rows + 1] - coverage_sums[window_starts]
+
+            window_min_coverage = window_seconds if min_coverage is None else min_coverage
+            is_complete = (window_coverage > 0) & (window_coverage >= window_min_coverage - 1e-9)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rolling_means[i] = np.where(is_complete, window_totals / window_coverage, np.nan)
+        return rolling_means
+
+    def rolling_max(self, values:Array, times:Array, window_seconds:float, weights:Optional[Array]=None, 
+                    min_coverage:Optional[float]=None) -> Array:
+        """
+        Trailing rolling max over the last @window_seconds of elapsed time of each partition (see rolling_mean).
+        The window maximums come from a sparse table of power-of-2 range maximums: O(n log(rows per window)).
+        """
+        values = np.asarray(values, dtype=float)
+        seconds = self.to_seconds(times)
+        weights = self._get_time_weights(seconds) if weights is None else np.asarray(weights, dtype=float)
+        window_starts = self._get_window_starts(seconds, window_seconds)
+        rows = np.arange(len(values))
+
+        # level k of the table holds the max of the 2^k rows starting at each row
+        table = [np.where(np.isnan(values), -np.inf, values)]
+        window_lengths = rows - window_starts + 1
+        max_level = int(np.log2(window_lengths.max())) if len(values) > 0 else 0
+        for k in range(1, max_level + 1):
+            previous, half = table[-1], 2**(k-1)
+            table.append(np.maximum(previous[:len(previous)-half], previous[half:]))
+
+        # The max of [start, row] is the max of the 2 (overlapping) power-of-2 ranges that cover it
+        levels = np.floor(np.log2(np.maximum(window_lengths, 1))).astype(int)
+        window_max = np.full(len(values), -np.inf)
+        for k in np.unique(levels):
+            filt_level = levels == k
+            window_max[filt_level] = np.maximum(table[k][window_starts[filt_level]], table[k][rows[filt_level] - 2**k + 1])
+
+        window_coverage = self._get_window_coverage(values, weights, window_starts)
+        min_coverage = window_seconds if min_coverage is None else min_coverage
+        is_complete = (window_coverage > 0) & (window_coverage >= min_coverage - 1e-9)
+        return np.where(is_complete & np.isfinite(window_max), window_max, np.nan)
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    @staticmethod
+    def _broadcast_rows(row_values:Array, values:Array) -> Array:
+        # Lines up a value per row with the shape of @values (rows,) or (rows, channels)
+        return row_values.reshape((-1,) + (1,) * (values.ndim - 1)) * np.ones((1,) + values.shape[1:], dtype=int)
+
+    def _get_window_starts(self, seconds:Array, window_seconds:float) -> Array:
+        # Row where the trailing time window (t - @window_seconds, t] of each row starts within its partition.
+        # Each partition is offset past the previous ones so that a single searchsorted can't cross a boundary.
+        if len(seconds) == 0:
+            return np.zeros(0, dtype=int)
+        partition_offset = (np.nanmax(seconds) - np.nanmin(seconds) + window_seconds + 1) * self.partition_rank
+        offset_seconds = seconds - np.nanmin(seconds) + partition_offset
+        window_starts = np.searchsorted(offset_seconds, offset_seconds - window_seconds, side='right')
+        return np.maximum(window_starts, self.starts[self.partition_rank])
+
+    @staticmethod
+    def _get_window_coverage(values:Array, weights:Array, window_starts:Array) -> Array:
+        # The seconds of non-NaN data within each row's window
+        coverage_sums = np.concatenate([[0.0], np.cumsum(np.where(np.isnan(values), 0.0, weights))])
+        rows = np.arange(len(values))
+        return coverage_sums[rows + 1] - coverage_sums[window_starts]
+
+    def _get_time_weights(self, seconds:Array) -> Array:
+        # The seconds each row covers: the time since the previous row of the partition (1 second for the first row)
+        weights = self.diff(seconds)
+        weights[self.is_start] = 1.0
+        return weights
+
+    @staticmethod
+    def to_seconds(times:Array) -> Array:
+        # Datetimes are converted to (float) seconds since 1970, numbers are taken as seconds
+        times = pd.Series(times) if not isinstance(times, pd.Series) else times
+        if pd.api.types.is_datetime64_any_dtype(times):
+            epoch = pd.Timestamp(0, tz=times.dt.tz)
+            return ((times - epoch) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+        return times.to_numpy(dtype=float)
+
+    def _set_boundaries(self, partition:Array) -> None:
+        n = len(partition)
+        self.is_start = np.zeros(n, dtype=bool)
+        self.is_start[:1] = True
+        if n > 1:
+            self.is_start[1:] = partition[1:] != partition[:-1]
+        self.starts = np.flatnonzero(self.is_start)
+        self.ends = np.append(self.starts[1:], n).astype(int)
+        self.partition_rank = np.cumsum(self.is_start) - 1
+
     
\ No newline at end of file
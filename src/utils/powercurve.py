@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from utils.training import NO_TRAINING_WINDOW
+
+# The @group_by value written in the rows of the all-time curve (the scope column tells the curves apart)
+ALL_TIME_GROUP = -1
+
+def get_curve_column(duration):
+    # Name of the Activity Log column holding a ride's mean-max power over @duration seconds
+    return f'mmp_{duration}s'
+
+def compute_mean_max_curve(power, durations, times=None, window=None):
+    """
+    Computes the mean-maximal power curve of a ride: for each of the @durations (in seconds) the highest 
+    average power held over any window of that length.
+
+    When a partitioned SegmentWindow @window and the @times of the rows are given, the windows cover real 
+    elapsed seconds and never span the pause between two segments (see SegmentWindow.rolling_mean).
+    Otherwise a duration is a number of consecutive samples (1 sample = 1 sec).
+
+    Every window sum comes from the difference of a cumulative sum of @power that is computed once for all of
+    the @durations (SegmentWindow.rolling_mean_many on the window path), so each duration only adds a vectorized
+    O(n) pass instead of its own rolling mean. Like rolling(window=duration).mean(), windows that
+    contain a NaN are skipped and durations longer than the ride (or any of its segments) are NaN.
+
+    Returns a numpy array of the mean-max power of each of the @durations
+    """
+    if window is not None:
+        rolling_means = window.rolling_mean_many(power, times, durations)
+        is_complete = ~np.isnan(rolling_means)
+        return np.where(is_complete.any(axis=1), np.max(rolling_means, axis=1, where=is_complete, initial=-np.inf), np.nan)
+
+    power = np.asarray(power, dtype='float64')
+    is_nan = np.isnan(power)
+    power_cumsum = np.concatenate([[0.0], np.cumsum(np.where(is_nan, 0.0, power))])
+    nan_cumsum = np.concatenate([[0], np.cumsum(is_nan)])
+
+    curve = np.full(len(durations), np.nan)
+    for i, duration in enumerate(durations):
+        if duration > len(power):
+            continue
+        window_sums = power_cumsum[duration:] - power_cumsum[:-duration]
+        filt_complete = (nan_cumsum[duration:] - nan_cumsum[:-duration]) == 0
+        if filt_complete.any():
+            curve[i] = window_sums[filt_complete].max() / duration
+    return curve
+
+def get_best_power_curves(df_log, durations, group_by='training_window_id'):
+    """
+    Builds the best (all-time and per @group_by) mean-max power curves from the per-ride curve columns of @df_log
+
+    Returns a dataframe of: scope | training_window_id | duration | best_power | ride_id
+    where scope is 'all_time' (training_window_id = ALL_TIME_GROUP) or 'training_window'
+    """
+    df_curves = _to_long_curves(df_log, durations, group_by)
+    return _select_best(_assign_scopes(df_curves, group_by), group_by)
+
+def update_best_power_curves(df_best, df_new_log, durations, group_by='training_window_id'):
+    """
+    Merges the per-ride curves of the new rides in @df_new_log into the previous best curves @df_best,
+    so that the best curves don't have to be rebuilt from every ride when new rides arrive.
+    """
+    df_curves = _to_long_curves(df_new_log, durations, group_by)
+    return _select_best(pd.concat([df_best, _assign_scopes(df_curves, group_by)], ignore_index=True), group_by)
+
+def _to_long_curves(df_log, durations, group_by):
+    # One row per ride and duration: ride_id | @group_by | duration | best_power
+    curve_columns = [get_curve_column(duration) for duration in durations]
+    df_curves = df_log.melt(id_vars=['ride_id', group_by], value_vars=curve_columns, var_name='duration', value_name='best_power')
+    df_curves['duration'] = df_curves['duration'].map(dict(zip(curve_columns, durations)))
+    return df_curves.dropna(subset=['best_power'])
+
+def _assign_scopes(df_curves, group_by):
+    # Every ride counts towards the all-time curve, the rides outside of every training window only count there
+    df_all_time = df_curves.assign(scope='all_time', **{group_by: ALL_TIME_GROUP})
+    df_grouped = df_curves.loc[df_curves[group_by] != NO_TRAINING_WINDOW].assign(scope='training_window')
+    return pd.concat([df_all_time, df_grouped], ignore_index=True)
+
+def _select_best(df_curves, group_by):
+    # Keep the ride with the highest power for each scope, @group_by and duration (the earliest ride_id on ties)
+    df_curves = df_curves.sort_values(['best_power', 'ride_id'], ascending=[False, True])
+    df_best = df_curves.drop_duplicates(subset=['scope', group_by, 'duration'], keep='first')
+    df_best = df_best.sort_values(['scope', group_by, 'duration']).reset_index(drop=True)
+    return df_best[['scope', group_by, 'duration', 'best_power', 'ride_id']]
@@ -0,0 +1,69 @@
+import pandas as pd
+
+# The dtype of every column a ride's dataframe can have, whichever stage wrote it.
+# - ride_id is the same value on every row of a ride, so it's stored as a category (1 byte per row)
+# - latitude/longitude stay float64, float32 only resolves ~1 meter which is too coarse for the 1 sec distance deltas
+# - elevation (and the elevation changes) stay float64 too, it is diffed into the grade and the ascent/descent
+# - every other sensor channel or derived measure is float32
+# - the int columns become their nullable dtype (e.g. 'Int16') in a ride whose column has missing values
+RIDE_SCHEMA = {'time': 'datetime64[ns, UTC]',
+               'ride_id': 'category',
+               'segment_id': 'int16',
+               'training_window_id': 'int16',
+               'elevation': 'float64',
+               'latitude': 'float64',
+               'longitude': 'float64',
+               'elapsed_time': 'float32',
+               'delta_time': 'float32',
+               'moving_time': 'float32',
+               'delta_dist': 'float32',
+               'heading': 'float32',
+               'speed': 'float32',
+               'is_cruising': 'bool',
+               'grade': 'float32',
+               'elapsed_ascent': 'float64',
+               'elapsed_descent': 'float64',
+               'elapsed_elevation': 'float64',
+               'filt_speed': 'float32',
+               'filt_grade': 'float32',
+               'inst_power': 'float32'
+              }
+
+# Columns that are left behind by older versions of the pipeline and are dropped when found
+DROPPED_COLUMNS = ['index', 'Unnamed: 0']
+
+def apply_ride_schema(df:pd.DataFrame, schema=None) -> pd.DataFrame:
+    """
+    Casts the columns of a ride's @df to the dtypes of the @schema (default: RIDE_SCHEMA) and drops the leftover
+    columns in DROPPED_COLUMNS. Columns that are not in the @schema are kept as they are.
+    """
+    if schema is None:
+        schema = RIDE_SCHEMA
+
+    df = df.drop(columns=[col for col in DROPPED_COLUMNS if col in df.columns])
+
+    for col, dtype in schema.items():
+        if (col not in df.columns) or (df[col].dtype == dtype):
+            continue
+        if dtype.startswith('datetime64'):
+            df[col] = pd.to_datetime(df[col], utc=True)
+        elif dtype == 'category':
+            # e.g. ride_id, which can come in as a float (2975587283.0)
+            df[col] = df[col].astype('int64').astype(dtype)
+        elif dtype.startswith('int'):
+            # e.g. a partially enriched ride file with a NaN training_window_id (or an empty one, parsed as object)
+            values = pd.to_numeric(df[col]).round()
+            df[col] = values.astype(dtype.capitalize() if values.isna().any() else dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+
+    return df
+
+def get_csv_dtypes(schema=None) -> dict:
+    """
+    Returns the {column: dtype} of the @schema (default: RIDE_SCHEMA) that pd.read_csv can parse directly
+    """
+    if schema is None:
+        schema = RIDE_SCHEMA
+    # ids are parsed as int64 first because older ride files store them as floats (e.g. 2975587283.0)
+    return {col: dtype for col, dtype in schema.items() if dtype.startswith('float')}
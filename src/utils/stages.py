@@ -0,0 +1,26 @@
+# The RideETL stages in the order the pipeline runs them: stage_name -> (RideETL method, description)
+# This module doesn't import anything so that the stages can be listed without loading the ETL modules
+RIDE_STAGES = {'extract': ('extract_gpx_to_csv', 'Extract the raw GPX files into ride files'),
+               'normalize': ('normalize_time_sampling', 'Resample the rides to 1 Hz and split them into segments'),
+               'enrich': ('basic_enrichment', 'Add the distance, speed, grade, heading and cruising flags'),
+               'privacy': ('protect_privacy_zones', 'Mask the GPS points inside of the privacy zones'),
+               'filter': ('filter_noise', 'Smooth the speed and grade with a Hann window filter'),
+               'power': ('estimate_ride_power', 'Estimate the instantaneous power from the physics model')
+              }
+
+# The stages run_fused_pipeline runs back to back on each ride
+FUSED_STAGES = ['normalize', 'enrich', 'privacy', 'filter', 'power']
+
+def parse_stage_names(stage_names):
+    """
+    Returns the @stage_names (a list or a comma separated string, None = every stage) in the order the
+    pipeline runs them, raising a ValueError for unknown stages
+    """
+    if stage_names is None:
+        return list(RIDE_STAGES.keys())
+    if isinstance(stage_names, str):
+        stage_names = [name.strip() for name in stage_names.split(',') if name.strip() != '']
+    unknown_stages = [name for name in stage_names if name not in RIDE_STAGES]
+    if len(unknown_stages) > 0:
+        raise ValueError(f'Unknown stage(s) {unknown_stages}. Choose from {list(RIDE_STAGES.keys())}')
+    return [name for name in RIDE_STAGES.keys() if name in stage_names]
@@ -0,0 +1,185 @@
+import pandas as pd
+from tqdm import tqdm
+from os import listdir, remove
+from os.path import isfile, join, getsize
+
+from utils.extract import get_ride_id, read_ride_csv
+from utils.schema import apply_ride_schema
+
+class RideStore():
+    """
+    A RideStore reads and writes a ride's dataframe as one file per ride in a single file format.
+    The CSV store is the default. The Parquet and Feather (Arrow IPC) stores keep the column dtypes
+    (e.g. the timestamps in 'time') so nothing has to be re-parsed from text, and they can read only the
+    requested @columns of a ride. These two stores need the optional pyarrow package.
+    """
+    file_format = None
+    extension = None
+
+    def file_name(self, output_path:str, ride_id) -> str:
+        return join(output_path, str(ride_id)+self.extension)
+
+    def read(self, file_path:str, columns=None) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def write(self, df:pd.DataFrame, output_path:str, ride_id) -> str:
+        raise NotImplementedError
+
+
+class CsvRideStore(RideStore):
+    file_format = 'csv'
+    extension = '.csv'
+
+    def read(self, file_path, columns=None):
+        return read_ride_csv(file_path, columns=columns)
+
+    def write(self, df, output_path, ride_id):
+        new_file_name = self.file_name(output_path, ride_id)
+        df.to_csv(new_file_name, index=False)
+        return new_file_name
+
+
+class ParquetRideStore(RideStore):
+    file_format = 'parquet'
+    extension = '.parquet'
+
+    def __init__(self, compression='zstd'):
+        self.compression = compression
+
+    def read(self, file_path, columns=None):
+        _require_pyarrow(self.file_format)
+        return pd.read_parquet(file_path, columns=columns)
+
+    def write(self, df, output_path, ride_id):
+        _require_pyarrow(self.file_format)
+        new_file_name = self.file_name(output_path, ride_id)
+        df.to_parquet(new_file_name, index=False, compression=self.compression)
+        return new_file_name
+
+
+class FeatherRideStore(RideStore):
+    file_format = 'feather'
+    extension = '.feather'
+
+    def __init__(self, compression='zstd'):
+        self.compression = compression
+
+    def read(self, file_path, columns=None):
+        _require_pyarrow(self.file_format)
+        return pd.read_feather(file_path, columns=columns)
+
+    def write(self, df, output_path, ride_id):
+        _require_pyarrow(self.file_format)
+        new_file_name = self.file_name(output_path, ride_id)
+        # Feather can't store a non-default index
+        df.reset_index(drop=True).to_feather(new_file_name, compression=self.compression)
+        return new_file_name
+
+
+RIDE_STORES = {'csv': CsvRideStore, 'parquet': ParquetRideStore, 'feather': FeatherRideStore}
+
+def get_ride_store(file_format:str) -> RideStore:
+    """
+    Returns the RideStore for a @file_format of 'csv', 'parquet' or 'feather'
+    """
+    if file_format not in RIDE_STORES:
+        raise ValueError(f'Unknown ride file format "{file_format}". Choose one of {list(RIDE_STORES.keys())}')
+    return RIDE_STORES[file_format]()
+
+def get_ride_store_for_file(file_path:str) -> RideStore:
+    """
+    Returns the RideStore that matches the extension of @file_path
+    """
+    for store_class in RIDE_STORES.values():
+        if file_path.endswith(store_class.extension):
+            return store_class()
+    raise ValueError(f'No ride store can read "{file_path}"')
+
+def read_ride_file(file_path:str, columns=None) -> pd.DataFrame:
+    """
+    Reads a ride file of any supported format. Only the @columns are read when given.
+    The columns are returned with the dtypes of the ride schema (see utils/schema.py)
+    """
+    df = get_ride_store_for_file(file_path).read(file_path, columns=columns)
+    return apply_ride_schema(df)
+
+def list_ride_files(input_path:str, extension=None) -> list:
+    """
+    Returns the sorted full paths of the ride files in @input_path, optionally only the ones ending in @extension
+    """
+    ride_files = listdir(input_path) # get all files and directories
+    ride_files = [join(input_path, f) for f in ride_files if f != '.gitignore'] # add full paths to files
+    ride_files = [f for f in ride_files if isfile(f)] # get only files, no directories
+    if extension is not None:
+        ride_files = [f for f in ride_files if f.endswith(extension)]
+    return sorted(ride_files)
+
+def migrate_ride_files(input_path:str, output_path:str, file_format:str, remove_source=False) -> pd.DataFrame:
+    """
+    One-shot conversion of every CSV ride file in @input_path into @file_format files in @output_path.
+    With @remove_source=True the CSV files are deleted once their converted file is written.
+
+    Returns a dataframe of the file size before and after for each ride
+    """
+    store = get_ride_store(file_format)
+    ride_files = list_ride_files(input_path, extension=CsvRideStore.extension)
+
+    print(f'Migrating {len(ride_files)} CSV ride files to {file_format}')
+    sizes = []
+    for ride_file in tqdm(ride_files):
+        ride_id = get_ride_id(ride_file)
+        df = read_ride_csv(ride_file)
+        new_file_name = store.write(df, output_path=output_path, ride_id=ride_id)
+        sizes.append({'ride_id':int(ride_id), 'csv_bytes':getsize(ride_file), f'{file_format}_bytes':getsize(new_file_name)})
+        if remove_source == True:
+            remove(ride_file)
+
+    df_sizes = pd.DataFrame(data=sizes)
+    if df_sizes.shape[0] > 0:
+        before, after = df_sizes['csv_bytes'].sum(), df_sizes[f'{file_format}_bytes'].sum()
+        print(f'Total size went from {before/1e6:.1f} MB to {after/1e6:.1f} MB')
+    return df_sizes
+
+def get_memory_report(ride_files:list) -> pd.DataFrame:
+    """
+    Compares the in-memory size of each of the @ride_files when read with pandas' default dtypes
+    against its size once the ride schema is applied (see utils/schema.py)
+
+    Returns a dataframe of the bytes before and after for each ride
+    """
+    print(f'Measuring the memory of {len(ride_files)} ride files')
+    sizes = []
+    for ride_file in tqdm(ride_files):
+        df = _read_default_dtypes(ride_file)
+        before = df.memory_usage(index=True, deep=True).sum()
+        after = apply_ride_schema(df).memory_usage(index=True, deep=True).sum()
+        sizes.append({'ride_id':int(get_ride_id(ride_file)), 'row_count':df.shape[0], 'bytes_before':before, 'bytes_after':after})
+
+    df_sizes = pd.DataFrame(data=sizes, columns=['ride_id', 'row_count', 'bytes_before', 'bytes_after'])
+    if df_sizes.shape[0] > 0:
+        before, after = df_sizes['bytes_before'].sum(), df_sizes['bytes_after'].sum()
+        print(f'The rides take {before/1e6:.1f} MB in memory with the default dtypes and {after/1e6:.1f} MB with the ride schema')
+    return df_sizes
+
+def _read_default_dtypes(ride_file):
+    # Reads a ride file the way it was read before the ride schema (every number as int64/float64)
+    if ride_file.endswith(CsvRideStore.extension):
+        df = pd.read_csv(ride_file)
+        if 'time' in df.columns:
+            df['time'] = pd.to_datetime(df['time'])
+        return df
+    df = get_ride_store_for_file(ride_file).read(ride_file)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype('float64')
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype('int64')
+    return df
+
+def _require_pyarrow(file_format):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(f'The "{file_format}" ride store needs the pyarrow package (pip install pyarrow)')
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+# The training_window_id of the times outside of the calendar
+NO_TRAINING_WINDOW = -1
+
+class TrainingCalendar():
+    """
+    The calendar of the training windows: window 0 starts on @start_date and every following window starts
+    @period_days later, so window i covers [start_date + i*period, start_date + (i+1)*period).
+
+    The window start times are kept as a sorted array of epoch seconds, so the windows of any number of times
+    are found with a single np.searchsorted. The array is only extended when a time past its end is looked up,
+    so an unlimited calendar (@n_windows=None) is built once per run for the span of the rides it sees.
+    """
+    def __init__(self, start_date='2020-01-02', period_days=56, n_windows=None):
+        """
+        Inputs:
+        @start_date = the (UTC) start of the first training window
+        @period_days = the length of every training window in days (56 days = 8 weeks)
+        @n_windows = the number of training windows (None = unlimited), later times get NO_TRAINING_WINDOW
+        """
+        if period_days <= 0:
+            raise ValueError(f'The training window period must be positive, got {period_days} days')
+        self.start_date = start_date
+        self.period_days = period_days
+        self.n_windows = n_windows
+        self.start_seconds = _to_epoch_seconds(pd.Series([pd.Timestamp(start_date)]))[0]
+        self.period_seconds = period_days * 24 * 3600.0
+        self.window_starts = np.array([self.start_seconds]) # epoch seconds of the start of each window built so far
+
+    @property
+    def params(self):
+        # The settings of the calendar, e.g. for the stage params of the manifest
+        return {'start_date': str(self.start_date), 'period_days': self.period_days, 'n_windows': self.n_windows}
+
+    ################################################################
+    # INTERFACE METHODS
+    ################################################################
+
+    def get_window_ids(self, times) -> np.ndarray:
+        """
+        Returns the training_window_id (int) of each of the @times (datetimes), NO_TRAINING_WINDOW for the times
+        before the first window, after the last window of a limited calendar, or missing (NaT)
+        """
+        seconds = _to_epoch_seconds(times)
+        is_valid = ~np.isnan(seconds)
+        if is_valid.any():
+            self._extend_window_starts(np.max(seconds[is_valid]))
+
+        window_ids = np.searchsorted(self.window_starts, np.where(is_valid, seconds, -np.inf), side='right') - 1
+        if self.n_windows is not None:
+            window_ids[window_ids >= self.n_windows] = NO_TRAINING_WINDOW
+        window_ids[window_ids < 0] = NO_TRAINING_WINDOW
+        return window_ids
+
+    def get_window_starts(self):
+        """
+        Returns a dataframe of the training windows built so far: training_window_id | start_date | end_date
+        """
+        n_windows = len(self.window_starts) - 1 if self.n_windows is None else min(len(self.window_starts), self.n_windows)
+        starts = pd.to_datetime(self.window_starts[:n_windows], unit='s', utc=True)
+        return pd.DataFrame({'training_window_id': np.arange(n_windows), 'start_date': starts,
+                             'end_date': starts + pd.Timedelta(days=self.period_days)})
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    def _extend_window_starts(self, max_seconds):
+        # Build the window starts up to the first window that starts after @max_seconds (or up to the last window)
+        n_needed = int(np.floor((max_seconds - self.start_seconds) / self.period_seconds)) + 2
+        if self.n_windows is not None:
+            n_needed = min(n_needed, self.n_windows + 1)
+        if n_needed > len(self.window_starts):
+            self.window_starts = self.start_seconds + self.period_seconds * np.arange(n_needed)
+
+
+def _to_epoch_seconds(times):
+    # Datetimes (naive ones are taken as UTC) to float seconds since 1970, NaT -> NaN
+    times = pd.Series(times) if not isinstance(times, pd.Series) else times
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        # e.g. the start_time of the Activity Log rides carried over from its CSV file next to new Timestamps
+        times = pd.to_datetime(times, utc=True, format='ISO8601')
+    times = times.dt.tz_localize('UTC') if times.dt.tz is None else times
+    seconds = (times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)
+    return seconds.to_numpy(dtype=float, na_value=np.nan)
@@ -1,138 +1,157 @@
 from os import stat
 import pandas as pd
 import numpy as np
-from haversine import haversine
-from scipy import signal
 
-from utils.pandaswindow import PandasWindow
+from utils.pandaswindow import SegmentWindow
+from utils.transform.enrich import haversine_array
 
 class SignalFilter():
-    def __init__(self, df):
+    def __init__(self, df, channels=None, window_order=10, method='auto'):
+        """
+        Inputs:
+        @df = the ride's dataframe
+        @channels = the columns to filter, each one gets a 'filt_<channel>' column (default: speed and grade)
+        @window_order = the number of points of the Hann window
+        @method = the convolution method of SegmentWindow.convolve: 'auto', 'direct', 'fft' or 'oa' (overlap-add)
+        """
         self.df = df
+        self.channels = ['speed', 'grade'] if channels is None else list(channels)
+        self.window_order = window_order
+        self.method = method
 
     def run(self):
-        self._filter_speed_signal()
-        self._filter_grade_signal()
+        self._filter_signals()
 
     ################################################################
     # PROCESS METHODS
     ################################################################
 
-    def _filter_speed_signal(self):
-        # Apply the is_cruising check over segment windows
-        window = PandasWindow(partition_by='segment_id', order_by='time')
-        self.df = window.apply_func(df=self.df, func=self.backfill_speed)
-        self.df = window.apply_func(df=self.df, func=self.apply_hann_filter_to_speed)
+    def _filter_signals(self):
+        # Filter every channel at once over the whole ride, the backfill and the convolution reset at each segment
+        window = SegmentWindow(partition_by='segment_id', order_by='time')
+        self.df = window.partition(self.df)
 
-    def _filter_grade_signal(self):
-        # Apply the is_cruising check over segment windows
-        window = PandasWindow(partition_by='segment_id', order_by='time')
-        self.df = window.apply_func(df=self.df, func=self.backfill_grade)
-        self.df = window.apply_func(df=self.df, func=self.apply_hann_filter_to_grade)
+        channel_values = self.df[self.channels].to_numpy(dtype=float)
+        channel_values = window.bfill(channel_values)
+        filtered_values = self.apply_hann_filter(window, channel_values, window_order=self.window_order, method=self.method)
+
+        for i, channel in enumerate(self.channels):
+            self.df[channel] = channel_values[:, i].astype(self.df[channel].dtype)
+            self.df['filt_'+channel] = filtered_values[:, i]
 
     ################################################################
     # HELPER METHODS
     ################################################################
 
     @staticmethod
-    def backfill_speed(df):
-        df = df.copy()
-        df['speed'] = df['speed'].interpolate(method='backfill')
-        return df
-    
-    @staticmethod
-    def backfill_grade(df):
-        df = df.copy()
-        df['grade'] = df['grade'].interpolate(method='backfill')
-        return df
-
-    @staticmethod
-    def apply_hann_filter_to_speed(df, signal_column='speed', window_order=10):
-        df = df.copy()
-        signal_list = list(df[signal_column].values)
-        win = signal.windows.hann(window_order)
-        filtered_signal = signal.convolve(signal_list, win, mode='same') / sum(win)
-        
-        df['filt_'+signal_column] = np.nan
-        if len(signal_list) == len(filtered_signal):
-            df['filt_'+signal_column] = filtered_signal
-        else:
-            df.loc[1:,'filt_'+signal_column] = filtered_signal
-            df.loc[0,'filt_'+signal_column] = df.loc[1,'filt_'+signal_column] # backfill
-        return df
-
-    @staticmethod
-    def apply_hann_filter_to_grade(df, signal_column='grade', window_order=10):
-        signal_list = list(df[signal_column].values)
+    def apply_hann_filter(window, values, window_order=10, method='auto'):
+        # Smooths the @values (rows, channels) of each of the partitions of @window with a normalized Hann window
+        from scipy import signal # slow to import, so only imported by the stage that filters
         win = signal.windows.hann(window_order)
-        filtered_signal = signal.convolve(signal_list, win, mode='same') / sum(win)
-        
-        df['filt_'+signal_column] = np.nan
-        if len(signal_list) == len(filtered_signal):
-            df['filt_'+signal_column] = filtered_signal
-        else:
-            df.loc[1:,'filt_'+signal_column] = filtered_signal
-            df.loc[0,'filt_'+signal_column] = df.loc[1,'filt_'+signal_column] # backfill
-        return df
+        return window.convolve(values, win, method=method) / sum(win)
 
 
 
 class PrivacyZoner():
-    def __init__(self, df, privacy_zone_path):
+    # Miles per degree of latitude (rounded down, the margins around the zones are padded by 10%)
+    miles_per_degree = 69.0
+
+    def __init__(self, df, privacy_zone_path=None, df_privacy=None, spatial_index_min_zones=8):
+        """
+        Inputs:
+        @df = the ride's dataframe
+        @privacy_zone_path = CSV file of privacy zones (name | latitude | longitude | privacy_radius in miles)
+        @df_privacy = the already loaded privacy zones, so a pipeline only reads the zone file once per run
+        @spatial_index_min_zones = number of nearby zones from which the ride points are indexed by latitude, so
+                                   each zone only measures the distance to the points within its latitude band
+        """
         self.df = df
         self.privacy_zone_path = privacy_zone_path
-        self.df_privacy = None
-        self.temporary_prox_columns = []
+        self.df_privacy = df_privacy
+        self.spatial_index_min_zones = spatial_index_min_zones
 
     def run(self):
-        self._read_privacy_zones()
-        self._calculate_proximities()
+        if self.df_privacy is None:
+            self._read_privacy_zones()
         self._remove_violation_gps_data()
-        self._drop_temporary_prox_columns()
 
     ################################################################
     # PROCESS METHODS
     ################################################################
 
     def _read_privacy_zones(self):
-        self.df_privacy = pd.read_csv(self.privacy_zone_path)
-
-    def _calculate_proximities(self):
-        for address_k in range(self.df_privacy.shape[0]):
-            # get the relevant parameters
-            dist_name = 'prox_' + self.df_privacy.loc[address_k, 'name']
-            latitude = self.df_privacy.loc[address_k, 'latitude']
-            longitude = self.df_privacy.loc[address_k, 'longitude']
-            
-            # calculate the proximity
-            self.df[dist_name] = self._get_proximity_to_address(latitude, longitude)
-            self.temporary_prox_columns.append(dist_name)
+        self.df_privacy = load_privacy_zones(self.privacy_zone_path)
 
     def _remove_violation_gps_data(self):
-        for address_k in range(self.df_privacy.shape[0]):
-             # get the relevant parameters
-            dist_name = 'prox_' + self.df_privacy.loc[address_k, 'name']
-            privacy_radius = self.df_privacy.loc[address_k, 'privacy_radius']
-
-            filt_violation = self.df.loc[:,dist_name] <= privacy_radius
-            self.df.loc[filt_violation, 'latitude'] = np.nan
-            self.df.loc[filt_violation, 'longitude'] = np.nan
-
-    def _drop_temporary_prox_columns(self):
-        self.df.drop(self.temporary_prox_columns, axis=1, inplace=True)
+        # Mask the GPS data of every point inside of any privacy zone in a single pass
+        filt_violation = self._get_violation_mask()
+        self.df.loc[filt_violation, 'latitude'] = np.nan
+        self.df.loc[filt_violation, 'longitude'] = np.nan
 
     ################################################################
     # HELPER METHODS
     ################################################################
 
-    def _get_proximity_to_address(self, addr_latitude, addr_longitude):
-        df_gps = self.df[['latitude', 'longitude']]
-        
-        # Define an anonymous function to execute over each row to calculate the distance between rows
-        haversine_distance = lambda x: haversine((x[0], x[1]), (addr_latitude, addr_longitude), unit='mi')
-        
-        # Create the distance column, making sure to apply the function row-by-row
-        proximity = df_gps.apply(haversine_distance, axis=1)
-        
-        return proximity
-    
\ No newline at end of file
+    def _get_violation_mask(self):
+        latitude = self.df['latitude'].to_numpy(dtype=float)
+        longitude = self.df['longitude'].to_numpy(dtype=float)
+        filt_violation = np.zeros(latitude.shape, dtype=bool)
+
+        # Only the zones that can reach the ride's bounding box need to be checked
+        df_zones = self._get_nearby_zones(latitude, longitude)
+        if df_zones.shape[0] == 0:
+            return filt_violation
+
+        zone_latitudes = df_zones['latitude'].to_numpy(dtype=float)
+        zone_longitudes = df_zones['longitude'].to_numpy(dtype=float)
+        zone_radii = df_zones['privacy_radius'].to_numpy(dtype=float)
+
+        if df_zones.shape[0] >= self.spatial_index_min_zones:
+            # Sort the ride points by latitude once, then each zone is a searchsorted for its latitude band
+            point_indices, sorted_latitudes = self._build_latitude_index(latitude, longitude)
+            lat_margins = 1.1 * zone_radii / self.miles_per_degree
+            band_starts = np.searchsorted(sorted_latitudes, zone_latitudes - lat_margins, side='left')
+            band_ends = np.searchsorted(sorted_latitudes, zone_latitudes + lat_margins, side='right')
+            for zone_lat, zone_long, zone_radius, start, end in zip(zone_latitudes, zone_longitudes, zone_radii, 
+                                                                     band_starts, band_ends):
+                band_indices = point_indices[start:end]
+                distances = haversine_array(latitude[band_indices], longitude[band_indices], zone_lat, zone_long)
+                filt_violation[band_indices[distances <= zone_radius]] = True
+        else:
+            # Check every point against each zone with vectorized distances
+            for zone_lat, zone_long, zone_radius in zip(zone_latitudes, zone_longitudes, zone_radii):
+                filt_violation |= haversine_array(latitude, longitude, zone_lat, zone_long) <= zone_radius
+
+        return filt_violation
+
+    def _get_nearby_zones(self, latitude, longitude):
+        # Keep the zones whose radius reaches the (padded) bounding box of the ride's GPS points
+        if np.all(np.isnan(latitude)) or np.all(np.isnan(longitude)):
+            return self.df_privacy.iloc[0:0]
+        lat_min, lat_max = np.nanmin(latitude), np.nanmax(latitude)
+        long_min, long_max = np.nanmin(longitude), np.nanmax(longitude)
+
+        # Convert each radius into degrees (with a 10% margin), widening the longitude margin by latitude
+        lat_margin = 1.1 * self.df_privacy['privacy_radius'] / self.miles_per_degree
+        max_abs_lat = min(max(abs(lat_min), abs(lat_max)) + lat_margin.max(), 89.0)
+        long_margin = lat_margin / np.cos(np.radians(max_abs_lat))
+
+        filt_nearby = ((self.df_privacy['latitude'] >= lat_min - lat_margin) & 
+                       (self.df_privacy['latitude'] <= lat_max + lat_margin) &
+                       (self.df_privacy['longitude'] >= long_min - long_margin) &
+                       (self.df_privacy['longitude'] <= long_max + long_margin))
+        return self.df_privacy.loc[filt_nearby]
+
+    @staticmethod
+    def _build_latitude_index(latitude, longitude):
+        # Returns the row positions of the valid ride points sorted by latitude, and their sorted latitudes
+        point_indices = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+        point_indices = point_indices[np.argsort(latitude[point_indices], kind='stable')]
+        return point_indices, latitude[point_indices]
+
+
+def load_privacy_zones(privacy_zone_path):
+    """
+    Loads the privacy zones CSV: name | latitude | longitude | privacy_radius (miles)
+    """
+    return pd.read_csv(privacy_zone_path)
@@ -1,21 +1,28 @@
 import pandas as pd
 import numpy as np
-from haversine import haversine
-import datetime as dt
 
 from utils.pandaswindow import PandasWindow
+from utils.metadata import get_ride_metadata
+from utils.training import NO_TRAINING_WINDOW
+
+# Same mean Earth radius as the haversine package (6371.0088 km) converted into miles
+AVG_EARTH_RADIUS_MI = 6371.0088 * 0.621371192
+
+def haversine_array(lat_1, long_1, lat_2, long_2):
+    """
+    Vectorized version of haversine((lat_1, long_1), (lat_2, long_2), unit='mi') that works on whole arrays 
+    (or scalars) of points in decimal degrees. A NaN in either point gives a NaN distance.
+    """
+    lat_1, long_1 = np.radians(lat_1), np.radians(long_1)
+    lat_2, long_2 = np.radians(lat_2), np.radians(long_2)
+    d = np.sin((lat_2 - lat_1) * 0.5)**2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((long_2 - long_1) * 0.5)**2
+    return 2 * AVG_EARTH_RADIUS_MI * np.arcsin(np.sqrt(d))
 
 
 def create_delta_time(df, time_column='time', fill_first=1.0):
     df = df.copy()
-    # Temporarily get the number of seconds since Jan. 1, 1970 as the UTC timestamp
-    df['time_utc'] = df[time_column].apply(lambda x: x.timestamp())
-    
-    # Calculate the row-wise difference in time (in seconds)
-    df['delta_time'] = df['time_utc'].diff()
-    
-    # drop the temporary time column
-    df.drop(['time_utc'], axis=1, inplace=True)
+    # Calculate the row-wise difference in time (in seconds) straight from the datetime column
+    df['delta_time'] = df[time_column].diff().dt.total_seconds()
     
     # fill in the initial value of delta_time with @fill_first
     df['delta_time'] = df['delta_time'].fillna(fill_first)
@@ -26,83 +33,130 @@ def create_duration_column(df, duration_column_name):
     df[duration_column_name] = df['delta_time'].cumsum()
     return df
 
+# 1 MPH = 0.44704 m/s
+MPH_TO_MPS = 0.44704
+
+def estimate_power(filt_speed, filt_grade, params, wind_velocity_component=0.0, return_forces=False):
+    """
+    Vectorized power model: the power needed to hold the @filt_speed (MPH) up the @filt_grade (%) against
+    gravity, rolling friction and air drag, after the drive train losses. Coasting (a negative sum of forces) is 0 W.
+
+    @params = dictionary of 'total_mass' (kg), 'gravity', 'mu_rr', 'rho_air', 'area', 'c_drag' and 'eta_dt'
+              (a 'cda' entry is used instead of 'area' * 'c_drag' when given).
+              Any param can be a 1D array of k values to evaluate k parameter sets at once, the results then have
+              a shape of (k, n) with a row per parameter set.
+    @wind_velocity_component = the wind speed (m/s) against the direction of motion, a scalar or an array like @filt_speed
+    @return_forces = True to also return the dictionary of the 'F_grav', 'F_fric', 'F_drag' and 'F_sum' forces (N)
+
+    Returns the inst_power (W) array (and the forces when @return_forces=True)
+    """
+    # A param with several values becomes a column so that it broadcasts against the ride's points
+    def get_param(name):
+        value = np.asarray(params[name], dtype=float)
+        return value.reshape(-1, 1) if value.ndim == 1 else value
+
+    # Convert the terrain slope into radians and the speed units into meters per second
+    grade_radians = np.arctan(np.asarray(filt_grade, dtype=float) / 100)
+    speed_mps = MPH_TO_MPS * np.asarray(filt_speed, dtype=float)
+    total_speed = speed_mps + wind_velocity_component
+
+    # Calculate the individual forces
+    total_mass, gravity = get_param('total_mass'), get_param('gravity')
+    cda = get_param('cda') if 'cda' in params else get_param('area') * get_param('c_drag')
+    F_grav = total_mass * gravity * np.sin(grade_radians)
+    F_fric = get_param('mu_rr') * total_mass * gravity * np.cos(grade_radians)
+    F_drag = 0.5 * get_param('rho_air') * cda * total_speed * np.abs(total_speed) # k(v)^2, pushing when the tailwind is faster
+    F_sum = F_drag + F_grav + F_fric
+
+    # Calculate the non-negative power delivered by the rider
+    inst_power = (1.0 / get_param('eta_dt')) * F_sum * speed_mps
+    inst_power = np.where(inst_power < 0, 0.0, inst_power) # coasting when sum of forces is negative (no input power)
+
+    if return_forces == True:
+        return inst_power, {'F_grav': F_grav, 'F_fric': F_fric, 'F_drag': F_drag, 'F_sum': F_sum}
+    return inst_power
+
 class PowerEstimator():
-    def __init__(self, df, calc_params, activity_log_path):
+    def __init__(self, df, calc_params, activity_log_path=None, ride_metadata=None, weather_table=None):
+        """
+        Inputs:
+        @df = the ride's dataframe
+        @calc_params = the Config's power_estimation_params (this dictionary is never modified)
+        @activity_log_path = path of the Activity Log to look up the bike weight in
+        @ride_metadata = an already loaded RideMetadata lookup of the Activity Log (used instead of @activity_log_path)
+        @weather_table = a WeatherTable to add the wind to the drag force (None = no wind)
+        """
         self.df = df
         self.calc_params = calc_params
         self.activity_log_path = activity_log_path
+        if ride_metadata is None:
+            ride_metadata = get_ride_metadata(activity_log_path)
+        self.ride_metadata = ride_metadata
+        self.weather_table = weather_table
     
     def run(self):
         self._get_instantaneous_power()
 
+    def sweep(self, param_sets, return_forces=False):
+        """
+        Evaluates the power model of the ride for many parameter sets in one batched call, without changing self.df
+
+        @param_sets = dictionary (or dataframe) of k values for each swept param, e.g. {'rider_mass': [80, 85], 'cda': [0.40, 0.45]}.
+                      The params that aren't swept come from the calc_params.
+
+        Returns the (k, n) array of inst_power with a row per parameter set (and the forces when @return_forces=True)
+        """
+        params = self._get_params(param_sets)
+        return estimate_power(self.df['filt_speed'].values, self.df['filt_grade'].values, params, 
+                              wind_velocity_component=self._get_wind_velocity_component(), return_forces=return_forces)
+
     ################################################################
     # PROCESS METHODS
     ################################################################
 
     def _get_instantaneous_power(self):
-        df = self.df.copy()
-        params = self.calc_params
-
-        # add a total_mass parameter based on the ride_id and activity log
-        ride_id = df.loc[0,'ride_id']
-        params['total_mass'] = params['rider_mass'] + self._get_bike_weight(ride_id=ride_id)
-        
-        # Convert the terrain slope into radians
-        df['filt_grade_radians'] = np.arctan(df['filt_grade']/100)
-        
-        # Convert the speed units into meters per second
-        mph2MpS = 0.44704 # 1 MPH = 0.44704 m/s
-        df['filt_speed_MpS'] = mph2MpS * df['filt_speed']
-        
-        # Get the total speed component with wind (placeholder)
-        df = self._get_wind_velocity_component(df, None)
-        df['total_speed'] = df['filt_speed_MpS'] + df['wind_velocity_component']
-        
-        # Calculate the individual forces
-        df['F_grav'] = params['total_mass']*params['gravity'] * np.sin(df['filt_grade_radians'])
-        df['F_fric'] = params['mu_rr']*params['total_mass']*params['gravity'] * np.cos(df['filt_grade_radians'])
-        full_coefficient = 0.5 * params['rho_air'] * params['area'] * params['c_drag']
-        df['F_drag'] = (full_coefficient) * np.power(df['total_speed'], 2) # k(v)^2
-        
-        # Sum the forces
-        df['F_sum'] = df['F_drag'] + df['F_grav'] + df['F_fric']
-        
-        # Calculate the non-negative power delivered by the ride (set Power=0 for F_sum <0)
-        df['inst_power'] = (1.0/params['eta_dt']) * df['F_sum'] * df['filt_speed_MpS'] 
-        df.loc[df['inst_power']<0,'inst_power'] = 0 # coasting when sum of forces is negative (no input power)
-        
-        # drop the temporary columns
-        cols_to_drop = ['filt_grade_radians','filt_speed_MpS','F_grav','F_fric','F_drag', 'F_sum', 
-                            'total_speed', 'wind_velocity_component']
-        df.drop(cols_to_drop, axis=1, inplace=True)
-
-        self.df = df
+        params = self._get_params()
+        self.df['inst_power'] = estimate_power(self.df['filt_speed'].values, self.df['filt_grade'].values, params,
+                                               wind_velocity_component=self._get_wind_velocity_component())
     
     ################################################################
     # HELPER METHODS
     ################################################################
 
-    @staticmethod
-    def _get_wind_velocity_component(df, df_log=None):
-        # TODO: add in weather data and a cosine between wind bearing and bike heading to project the contribution of wind
-        # onto the direction of motion
-        df = df.copy()
-        df['wind_velocity_component'] = 0 # constant zero for now
-        return df
+    def _get_params(self, param_sets=None):
+        params = dict(self.calc_params) # copy so the shared params aren't modified
+        if param_sets is not None:
+            params.update({name: np.asarray(values, dtype=float) for name, values in dict(param_sets).items()})
+
+        # add a total_mass parameter based on the ride_id and activity log
+        ride_id = self.df['ride_id'].iloc[0]
+        params['total_mass'] = np.asarray(params['rider_mass'], dtype=float) + self._get_bike_weight(ride_id=ride_id)
+        return params
+
+    def _get_wind_velocity_component(self):
+        # Project the wind of the weather observations onto the bike's heading (headwind > 0, tailwind < 0)
+        if self.weather_table is None:
+            return 0.0 # no wind
+        ride_id = self.df['ride_id'].iloc[0]
+        return self.weather_table.get_headwind(ride_id, self.df['time'], self.df['heading'].values)
 
     def _get_bike_weight(self, ride_id):
-        # open the activity log to look up the bike weight
-        df_log = pd.read_csv(self.activity_log_path)
-        # find the bike weight for the ride
-        df_log = df_log.set_index('ride_id')
-        bike_weight = df_log.loc[ride_id, 'bike_weight']
+        # find the bike weight for the ride in the activity log lookup
+        if ride_id not in self.ride_metadata:
+            raise KeyError(f'Ride {ride_id} is not in the activity log {self.ride_metadata.activity_log_path}')
+        bike_weight = self.ride_metadata.get(ride_id, 'bike_weight')
         return bike_weight
 
 
 
 class BasicEnricher():
-    def __init__(self, df):
+    def __init__(self, df, upper_cruising_threshold=8, lower_cruising_threshold=5, training_calendar=None):
         self.df = df
+        # Hysteresis thresholds (MPH) to start and stop cruising
+        self.upper_cruising_threshold = upper_cruising_threshold
+        self.lower_cruising_threshold = lower_cruising_threshold
+        # The ride's training window is broadcast to every point when a TrainingCalendar is given (see utils/training.py)
+        self.training_calendar = training_calendar
     
     def run(self):
         self._get_delta_distance()
@@ -119,10 +173,11 @@ class BasicEnricher():
     ################################################################
 
     def _get_delta_distance(self):
-        # Apply the distance calculation over segment windows to avoid huge delta_distances
-        # at the start of each segment
-        window = PandasWindow(partition_by='segment_id', order_by='time')
-        self.df = window.apply_func(df=self.df, func=self.compute_distance)
+        # Apply the distance calculation over the whole ride, masking the first row of each segment 
+        # to avoid huge delta_distances at the start of each segment
+        if not self.df['time'].is_monotonic_increasing:
+            self.df = self.df.sort_values('time', ignore_index=True)
+        self.df = self.compute_distance(df=self.df, partition_by='segment_id')
 
     def _get_heading(self):
         self.df = self.compute_heading(df=self.df)
@@ -131,9 +186,9 @@ class BasicEnricher():
         self.df = self.compute_speed(df=self.df)
 
     def _get_is_cruising(self):
-        # Apply the is_cruising check over segment windows to flag state propogation
-        window = PandasWindow(partition_by='segment_id', order_by='time')
-        self.df = window.apply_func(df=self.df, func=self.check_is_cruising)
+        # Apply the is_cruising check over the whole ride, restarting the state propogation at each segment
+        self.df = self.check_is_cruising(df=self.df, upper_threshold=self.upper_cruising_threshold, 
+                                         lower_threshold=self.lower_cruising_threshold, partition_by='segment_id')
 
     def _convert_elevation_units(self):
         # We must double check the units of the elevation. 
@@ -147,69 +202,54 @@ class BasicEnricher():
     def _get_elevation_changes(self):
         self.df = self.compute_cumulative_elevation_changes(df=self.df)
 
-    def _get_training_window_id(self, training_period=8):
-        # Initialize the start date and iteration steps of the training periods
-        start = dt.datetime(year=2020, month=1, day=2)
-        window_period = dt.timedelta(weeks=training_period)
-        
-        # Generate a dataframe containing window IDs and their start dates
-        data = [{'training_window_id':i, 'start_date':start+window_period*i} for i in range(0,13)]
-        df_training_dates = pd.DataFrame(data=data)
-        df_training_dates['start_date'] = pd.to_datetime(df_training_dates['start_date']) # make datetime for pandas
-        df_training_dates = df_training_dates.set_index('start_date').tz_localize('UTC').sort_index().reset_index() # add TZ for merge
-
-        # Find the window ID via merge_asof
-        df_temp = pd.merge_asof(self.df[['time']], df_training_dates, left_on='time', right_on='start_date')
-
-        # Assign the window ID back into the core dataframe
-        self.df['training_window_id'] = df_temp['training_window_id']
+    def _get_training_window_id(self):
+        # The whole ride belongs to the training window its first point falls in
+        if self.training_calendar is None:
+            return
+        window_ids = self.training_calendar.get_window_ids(self.df['time'].iloc[:1])
+        self.df['training_window_id'] = window_ids[0] if len(window_ids) > 0 else NO_TRAINING_WINDOW
 
     ################################################################
     # HELPER METHODS
     ################################################################
 
     @staticmethod
-    def compute_distance(df, latitude='latitude', longitude='longitude', fill_first=np.nan):
+    def compute_distance(df, latitude='latitude', longitude='longitude', fill_first=np.nan, partition_by=None):
+        """
+        Adds the 'delta_dist' (miles) column between each row and the previous row.
+        The first row (of each @partition_by group when given, e.g. 'segment_id') gets @fill_first.
+        """
         df = df.copy()
-        # Copy the previous values of Lat/Long to the current row for vectorized computation
-        df['lat_old'] = df[latitude].shift()
-        df['long_old'] = df[longitude].shift()
-        
-        # Grab the relevant columns for distance calculation
-        df_gps = df[['lat_old', 'long_old', latitude, longitude]]
+        lat = df[latitude].to_numpy(dtype=float)
+        long = df[longitude].to_numpy(dtype=float)
+
+        # Compare each point to the previous point for vectorized computation
+        delta_dist = np.full(lat.shape, np.nan)
+        delta_dist[1:] = haversine_array(lat[:-1], long[:-1], lat[1:], long[1:])
         
-        # Define an anonymous function to execute over each row to calculate the distance between rows
-        haversine_distance = lambda x: haversine((x[0], x[1]), (x[2], x[3]), unit='mi')
+        # Mask the rows that start a new partition, where there is no previous point to measure from
+        if partition_by is not None:
+            partition = df[partition_by].to_numpy()
+            delta_dist[1:][partition[1:] != partition[:-1]] = np.nan
         
-        # Create the distance column, making sure to apply the function row-by-row
-        df['delta_dist'] = df_gps.apply(haversine_distance, axis=1)
+        df['delta_dist'] = delta_dist
         df['delta_dist'] = df['delta_dist'].fillna(fill_first)
-        
-        # Remove the old latitude and longitude columns
-        df.drop(['lat_old','long_old'], axis=1, inplace=True)
         return df
 
     @staticmethod
     def compute_heading(df, latitude='latitude', longitude='longitude'):
         df = df.copy()
-        # Copy the previous values of Lat/Long to the current row for vectorized computation
-        df['lat_old'] = df[latitude].shift()
-        df['long_old'] = df[longitude].shift()
+        lat = df[latitude].to_numpy(dtype=float)
+        long = df[longitude].to_numpy(dtype=float)
         
-        # Grab the relevant columns for distance calculation
-        df_gps = df[['lat_old', 'long_old', latitude, longitude]]
-        
-        # Define an anonymous function to execute over each row to calculate the angle with North as 0 degrees
+        # Calculate the angle between each point and the previous point
         # NOTE: we use "delta_lat / delta_long" to ensure that North = 0 degrees
         rad2deg = 180.0 / np.pi
-        haversine_distance = lambda x: rad2deg * np.arctan2((x[2]-x[0]), (x[3]-x[1])) # atan(delta_lat / delta_long)
-        
-        # Create the distance column, making sure to apply the function row-by-row
-        df['heading'] = df_gps.apply(haversine_distance, axis=1)
-        df['heading'] = df['heading'].apply(lambda x: x + 360.0*(1-np.sign(x))/2) # correct for negative angles
+        heading = np.full(lat.shape, np.nan)
+        heading[1:] = rad2deg * np.arctan2((lat[1:]-lat[:-1]), (long[1:]-long[:-1])) # atan(delta_lat / delta_long)
+        heading = heading + 360.0*(1-np.sign(heading))/2 # correct for negative angles
         
-        # Remove the old latitude and longitude columns
-        df.drop(['lat_old','long_old'], axis=1, inplace=True)
+        df['heading'] = heading
         return df
 
     @staticmethod
@@ -220,21 +260,29 @@ class BasicEnricher():
         return df
 
     @staticmethod
-    def check_is_cruising(df, upper_threshold=8, lower_threshold=5):
-        df = df.copy().reset_index()
+    def check_is_cruising(df, upper_threshold=8, lower_threshold=5, partition_by=None):
+        """
+        Adds the 'is_cruising' hysteresis state: it turns True once the speed reaches @upper_threshold and
+        only turns False again once the speed drops below @lower_threshold. 
+        The state starts False on the first row (of each @partition_by group when given, e.g. 'segment_id')
+        """
+        df = df.copy()
+        speed = df['speed'].to_numpy(dtype=float)
+        
+        # Mark the rows where the state is set: 1 = rising threshold surpassed, 0 = falling threshold exceeded
+        # NaN = no change, so the previous state gets propogated
+        state = np.where(speed >= upper_threshold, 1.0, np.where(speed < lower_threshold, 0.0, np.nan))
         
-        df['is_cruising'] = False
+        # Every partition starts out not cruising
+        is_start = np.zeros(speed.shape, dtype=bool)
+        is_start[:1] = True
+        if partition_by is not None:
+            partition = df[partition_by].to_numpy()
+            is_start[1:] = partition[1:] != partition[:-1]
+        state[is_start] = 0.0
         
-        for k in range(1, df.shape[0]):
-            previous_state = df.loc[k-1,'is_cruising']
-            current_speed = df.loc[k,'speed']
-            if (previous_state==False) & (current_speed >= upper_threshold):
-                df.loc[k,'is_cruising'] = True # rising threshold surpassed
-            elif (previous_state==True) & (current_speed < lower_threshold):
-                df.loc[k,'is_cruising'] = False # falling threshold exceeded
-            else:
-                # if there is no change, propogate the previous state
-                df.loc[k,'is_cruising'] = df.loc[k-1,'is_cruising']
+        # Propogate each state forward until the next change
+        df['is_cruising'] = pd.Series(state, index=df.index).ffill().astype(bool)
         
         return df
 
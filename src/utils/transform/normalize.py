@@ -1,4 +1,6 @@
-from utils.pandaswindow import PandasWindow
+import numpy as np
+import pandas as pd
+
 from utils.transform.enrich import create_delta_time, create_duration_column
 
 
@@ -27,54 +29,99 @@ class TimeNormalizer():
         # Timestamps that are equal might also mess with calculations that
         # utilize delta_time 
         self.df = self.df.drop_duplicates(subset=['time'], keep='first')
+        # The upsampling below needs the rows in time order
+        if not self.df['time'].is_monotonic_increasing:
+            self.df = self.df.sort_values('time', kind='stable')
+        self.df = self.df.reset_index(drop=True)
 
     def _define_segment_ids(self):
-        # get the time gap indices
-        time_gap_indices = self._get_time_gap_indices()
-
-        # intialize the initial segment_id. to be incremented for each region of continuous data
-        segment_id_counter = 0
-        # initialize the starting index of the first segment
-        segment_start_index = 0
-
-        for time_gap_index in time_gap_indices:
-            # Assign the Segment ID
-            self.df.loc[segment_start_index:time_gap_index-1, 'segment_id'] = segment_id_counter
-            
-            # update the segment_id counter and start index
-            segment_id_counter += 1
-            segment_start_index = time_gap_index
-            
-        # Since segment_id == -1 by default, this represents the final segment of activity once parsed
-        self.df['segment_id'] = self.df['segment_id'].replace({-1:segment_id_counter})
+        # A new segment starts at every time gap, so the segment_id is the running count of time gaps
+        # (the first row's delta_time is filled with 1 second, so the first segment is always 0)
+        filt_time_jump = self.df['delta_time'] >= self.time_gap_threshold
+        self.df['segment_id'] = filt_time_jump.cumsum().astype('int64')
 
         # Since the delta_time column is no longer needed to detect discontinuities,
         # Drop delta_time so we can rebuild it at a segment_id level
         self.df.drop(['delta_time'], axis=1, inplace=True)
 
     def _upsample_time(self):
-        # Apply the Resampling/Interpolation at a 1 Hz sample frequency to each segment using a PandasWindow
-        window = PandasWindow(partition_by='segment_id', order_by='time')
-        self.df_upsampled = window.apply_func(df=self.df, func=self.upsample_and_interpolate)
+        # Resample every segment onto a 1 Hz grid and linearly interpolate all of the segments at once
+        self.df_upsampled = self.upsample_and_interpolate(self.df, time_column='time', partition_by='segment_id')
         
-        # Apply the delta_time function across each section
-        self.df_upsampled = window.apply_func(df=self.df_upsampled, func=create_delta_time)
+        # Rebuild delta_time across each segment (the first row of each segment gets 1 second)
+        delta_time = self.df_upsampled['time'].diff().dt.total_seconds()
+        is_segment_start = self.df_upsampled['segment_id'].diff() != 0
+        self.df_upsampled['delta_time'] = delta_time.mask(is_segment_start, 1.0)
 
 
     ################################################################
     # HELPER METHODS
     ################################################################
 
-    def _get_time_gap_indices(self):
-        # Calculate when the time discontinuities occur
-        filt_time_jump = self.df['delta_time'] >= self.time_gap_threshold
-        time_gap_indices = list(self.df.loc[filt_time_jump, 'time'].index)
-        return time_gap_indices
-
     @staticmethod
-    def upsample_and_interpolate(df, time_column='time', method='linear', limit_direction='forward'):
-        # set the timestamp as the index for the dataframe
-        df = df.set_index(time_column).copy()
-        df_upsampled = df.resample('S').interpolate(method=method, limit_direction=limit_direction).reset_index()
-        
-        return df_upsampled
+    def upsample_and_interpolate(df, time_column='time', partition_by='segment_id'):
+        """
+        Same as running df.set_index(time).resample('S').interpolate(method='linear', limit_direction='forward') on each 
+        @partition_by group of @df (sorted by @time_column), but done on int64 epoch arrays for all of the groups at once. 
+        The @partition_by and 'ride_id' columns are carried over as constants for each group.
+        """
+        times = df[time_column]
+        epoch = pd.Timestamp(0, tz=times.dt.tz)
+        t = ((times - epoch) / pd.Timedelta(seconds=1)).to_numpy(dtype=float) # seconds since 1970 (float)
+        t_floor = ((times - epoch) // pd.Timedelta(seconds=1)).to_numpy(dtype='int64') # whole seconds since 1970
+        partition = df[partition_by].to_numpy()
+
+        # Find where each group starts and ends
+        is_start = np.ones(len(df), dtype=bool)
+        is_start[1:] = partition[1:] != partition[:-1]
+        starts = np.flatnonzero(is_start)
+        ends = np.append(starts[1:], len(df)) - 1
+        group_rank = np.cumsum(is_start) - 1
+
+        # Build the 1 second grid of every group: floor(first time) ... floor(last time)
+        grid_counts = t_floor[ends] - t_floor[starts] + 1
+        grid_group = np.repeat(np.arange(len(starts)), grid_counts)
+        grid_offsets = np.arange(grid_counts.sum()) - np.repeat(np.cumsum(grid_counts) - grid_counts, grid_counts)
+        grid = np.repeat(t_floor[starts], grid_counts) + grid_offsets
+
+        # Build the upsampled dataframe
+        data = {time_column: pd.to_datetime(grid, unit='s', utc=(times.dt.tz is not None))}
+        constant_columns = [partition_by, 'ride_id']
+        for col in df.columns:
+            if col == time_column:
+                continue
+            values = df[col].to_numpy()
+            if (col in constant_columns) or not np.issubdtype(values.dtype, np.number):
+                data[col] = values[starts][grid_group] # constant within each group
+            else:
+                data[col] = _interpolate_groups(grid, grid_group, t, group_rank, values.astype(float))
+
+        return pd.DataFrame(data=data)
+
+
+def _interpolate_groups(grid, grid_group, t, group_rank, values):
+    """
+    Linearly interpolates @values (sampled at times @t) at the @grid times, only ever between two points 
+    of the same group. Like pandas' interpolate(limit_direction='forward'), NaNs before a group's first 
+    valid value stay NaN and the times after its last valid value hold that last value.
+    """
+    interpolated = np.full(grid.shape, np.nan)
+    filt_valid = ~np.isnan(values)
+    t, group_rank, values = t[filt_valid], group_rank[filt_valid], values[filt_valid]
+    if len(values) == 0:
+        return interpolated
+
+    # The valid point at or just before each grid time, and the one right after it
+    prev_point = np.searchsorted(t, grid, side='right') - 1
+    next_point = prev_point + 1
+    prev_safe, next_safe = np.clip(prev_point, 0, len(t)-1), np.clip(next_point, 0, len(t)-1)
+    has_prev = (prev_point >= 0) & (group_rank[prev_safe] == grid_group)
+    has_next = (next_point < len(t)) & (group_rank[next_safe] == grid_group)
+
+    # Interpolate between the 2 points when both are in the group, otherwise hold the previous value
+    t_0, t_1 = t[prev_safe], t[next_safe]
+    v_0, v_1 = values[prev_safe], values[next_safe]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(has_next & (t_1 > t_0), (grid - t_0) / (t_1 - t_0), 0.0)
+    interpolated = np.where(has_prev, v_0 + fraction * (v_1 - v_0), np.nan)
+    return interpolated
@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from os.path import getmtime, getsize
+
+class WeatherTable():
+    """
+    Time-indexed lookup of the wind from a weather observation table (CSV):
+        observation_time | wind_speed (m/s) | wind_bearing (degrees the wind comes from, clockwise from North)
+
+    The observations are kept as sorted epoch-second arrays so the wind at any time is a single searchsorted and
+    a linear interpolation between the 2 closest observations. The wind is interpolated as a vector (not as a
+    bearing) so that e.g. 350 and 10 degrees average to North. Times further than @max_gap_seconds from any
+    observation have no wind data (NaN).
+
+    The wind of each ride is cached by ride_id, so re-estimating the power of a ride (e.g. parameter sweeps)
+    doesn't look it up again.
+    """
+    def __init__(self, weather_path, time_column='observation_time', max_gap_seconds=3*3600, cache_size=256):
+        """
+        Inputs:
+        @weather_path = path to the weather observation CSV (the Activity Log also works with
+                        @time_column='weather_observation_time' since it holds an observation for each ride)
+        @time_column = the column of the observation times (UTC)
+        @max_gap_seconds = how far (in seconds) from an observation its wind is still used
+        @cache_size = the number of rides whose wind is kept in the cache
+        """
+        self.weather_path = weather_path
+        self.time_column = time_column
+        self.max_gap_seconds = max_gap_seconds
+        self.cache_size = cache_size
+        self._cache = OrderedDict() # ride_id -> (wind_east, wind_north)
+        self._file_signature = None
+        self._load()
+
+    def __len__(self):
+        return len(self.observation_seconds)
+
+    def __getstate__(self):
+        # The per ride cache isn't sent along to the worker processes
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def is_stale(self):
+        return self._file_signature != (getmtime(self.weather_path), getsize(self.weather_path))
+
+    def refresh(self):
+        # Reload the table only if the observation file changed since it was loaded
+        if self.is_stale():
+            self._load()
+        return self
+
+    ################################################################
+    # INTERFACE METHODS
+    ################################################################
+
+    def get_wind(self, times):
+        """
+        Returns the (east, north) components (m/s) of the vector pointing to where the wind comes from at each of the
+        @times (datetimes or epoch seconds), NaN where there is no observation within max_gap_seconds
+        """
+        seconds = _to_epoch_seconds(times)
+        n_obs = len(self.observation_seconds)
+        if n_obs == 0:
+            return np.full(seconds.shape, np.nan), np.full(seconds.shape, np.nan)
+
+        # The observation at or just before each time, and the one right after it
+        i_next = np.clip(np.searchsorted(self.observation_seconds, seconds, side='right'), 1, max(n_obs-1, 1))
+        i_prev = i_next - 1
+        if n_obs == 1:
+            i_prev = i_next = np.zeros(seconds.shape, dtype=int)
+        t_0, t_1 = self.observation_seconds[i_prev], self.observation_seconds[i_next]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip(np.where(t_1 > t_0, (seconds - t_0) / (t_1 - t_0), 0.0), 0.0, 1.0)
+        wind_east = self.wind_east[i_prev] + fraction * (self.wind_east[i_next] - self.wind_east[i_prev])
+        wind_north = self.wind_north[i_prev] + fraction * (self.wind_north[i_next] - self.wind_north[i_prev])
+
+        # No wind data far away from every observation
+        gap = np.minimum(np.abs(seconds - t_0), np.abs(t_1 - seconds))
+        filt_too_far = gap > self.max_gap_seconds
+        wind_east[filt_too_far], wind_north[filt_too_far] = np.nan, np.nan
+        return wind_east, wind_north
+
+    def get_ride_wind(self, ride_id, times):
+        """
+        Same as get_wind(@times) for the points of a ride, cached by @ride_id (and the ride's time span)
+        """
+        seconds = _to_epoch_seconds(times)
+        key = (int(ride_id), len(seconds), seconds[0] if len(seconds) > 0 else None, seconds[-1] if len(seconds) > 0 else None)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        wind = self.get_wind(seconds)
+        self._cache[key] = wind
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return wind
+
+    def get_headwind(self, ride_id, times, heading):
+        """
+        Returns the wind speed (m/s) against the direction of motion of each point of a ride (negative = tailwind).
+        @heading = the direction of motion of each point in degrees counter-clockwise from East (BasicEnricher.compute_heading)
+        Points without wind data or without a heading get no wind (0 m/s).
+        """
+        wind_east, wind_north = self.get_ride_wind(ride_id, times)
+        headwind = project_wind(wind_east, wind_north, heading)
+        return np.where(np.isnan(headwind), 0.0, headwind)
+
+    ################################################################
+    # HELPER METHODS
+    ################################################################
+
+    def _load(self):
+        self._file_signature = (getmtime(self.weather_path), getsize(self.weather_path))
+        self._cache.clear()
+        df_weather = pd.read_csv(self.weather_path, usecols=[self.time_column, 'wind_speed', 'wind_bearing'])
+        df_weather = df_weather.dropna()
+        df_weather[self.time_column] = pd.to_datetime(df_weather[self.time_column], utc=True)
+        df_weather = df_weather.sort_values(self.time_column).drop_duplicates(subset=[self.time_column], keep='last')
+
+        self.observation_seconds = _to_epoch_seconds(df_weather[self.time_column])
+        # The vector pointing to where the wind comes from (East, North components)
+        bearing_radians = np.radians(df_weather['wind_bearing'].to_numpy(dtype=float))
+        wind_speed = df_weather['wind_speed'].to_numpy(dtype=float)
+        self.wind_east = wind_speed * np.sin(bearing_radians)
+        self.wind_north = wind_speed * np.cos(bearing_radians)
+
+
+def project_wind(wind_east, wind_north, heading):
+    """
+    Projects the wind (the East/North components of the direction it comes from) onto the direction of motion.
+    @heading = the direction of motion in degrees counter-clockwise from East
+    Returns the headwind speed (negative = tailwind)
+    """
+    heading_radians = np.radians(np.asarray(heading, dtype=float))
+    return wind_east * np.cos(heading_radians) + wind_north * np.sin(heading_radians)
+
+def _to_epoch_seconds(times):
+    # Datetimes are converted to (float) seconds since 1970, numbers are taken as seconds
+    if isinstance(times, np.ndarray) and np.issubdtype(times.dtype, np.number):
+        return times.astype(float)
+    times = pd.Series(times) if not isinstance(times, pd.Series) else times
+    if pd.api.types.is_datetime64_any_dtype(times):
+        times = times.dt.tz_localize('UTC') if times.dt.tz is None else times
+        return ((times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+    return times.to_numpy(dtype=float)
+
+
+# Tables shared by everything in this process, by file path
+_weather_table_cache = {}
+
+def get_weather_table(weather_path, time_column='observation_time'):
+    """
+    Returns the WeatherTable of @weather_path, only reading the file again when it changed since the last call
+    """
+    key = (weather_path, time_column)
+    weather_table = _weather_table_cache.get(key)
+    if weather_table is None:
+        weather_table = WeatherTable(weather_path, time_column=time_column)
+        _weather_table_cache[key] = weather_table
+    return weather_table.refresh()